@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput / latency benchmarks for GfcApi against the local mock server.
+
+    python benchmark.py --prediction-sets 20000 --latency 0.02 --workers 4
+
+Reports records/sec, wall time, peak traced memory and time spent sleeping in the
+rate limiter for full pulls, incremental syncs and bulk submissions.
+@author: tiffany
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import iarpa_functions as iarpa
+from iarpa_mock_server import MockData, MockGfcServer
+
+class TimedRateLimiter(iarpa.RateLimiter):
+    """
+        A RateLimiter that adds up how long callers were made to wait.
+    """
+    def __init__(self,*args,**kwargs):
+        iarpa.RateLimiter.__init__(self,*args,**kwargs)
+        self.slept = 0.0
+        self.calls = 0
+
+    def acquire(self):
+        wait = iarpa.RateLimiter.acquire(self)
+        self.slept += wait
+        self.calls += 1
+        return wait
+
+def measure(name,fn,server):
+    """
+        Run fn() -> (records, limiter) and collect the timings.
+    """
+    sent = server.bytes_sent
+    tracemalloc.start()
+    start = time.perf_counter()
+    records, limiter = fn()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'benchmark':name,
+            'records':records,
+            'wall_s':round(wall,3),
+            'records_per_s':round(records/wall,1) if wall else None,
+            'requests':limiter.calls,
+            'sleep_s':round(limiter.slept,3),
+            'sleep_share':round(limiter.slept/wall,3) if wall else None,
+            'wire_mb':round((server.bytes_sent-sent)/2**20,2),
+            'peak_mb':round(peak/2**20,2)}
+
+def client(server,args,workers=1):
+    limiter = TimedRateLimiter(rate=args.rate,burst=args.burst)
+    gf = iarpa.GfcApi('benchmark-token',server.url,page_workers=workers,rate_limiter=limiter,
+                      per_page=args.per_page)
+    return gf, limiter
+
+def full_pull(server,args,workers):
+    def run():
+        gf, limiter = client(server,args,workers)
+        n = 0
+        for batch in gf.iter_human_forecasts(batches=True):
+            n += len(batch)
+        return n, limiter
+    return run
+
+def incremental_sync(server,args):
+    from iarpa_store import LocalStore
+    from iarpa_sync import SyncEngine
+
+    root = tempfile.mkdtemp(prefix='gfc_bench_')
+    gf, _ = client(server,args)
+    SyncEngine(gf,LocalStore(root)).sync('prediction_sets')
+    server.data.add_prediction_sets(args.delta)
+
+    def run():
+        try:
+            gf, limiter = client(server,args)
+            return SyncEngine(gf,LocalStore(root)).sync('prediction_sets'), limiter
+        finally:
+            shutil.rmtree(root,ignore_errors=True)
+    return run
+
+def bulk_submit(server,args):
+    questions = server.data.questions
+    jobs = []
+    for i in range(args.submissions):
+        q = questions[i % len(questions)]
+        jobs.append((q['id'],'benchmark_{}'.format(i % 25),
+                     [{'answer_id':a['id'],'value':a['probability']} for a in q['answers']]))
+
+    def run():
+        gf, limiter = client(server,args)
+        report = gf.submit_forecasts(jobs,questions=questions,workers=args.workers)
+        return int((report['status'] == 'submitted').sum()), limiter
+    return run
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GfcApi against a local mock server')
+    parser.add_argument('--questions',type=int,default=200)
+    parser.add_argument('--prediction-sets',type=int,default=20000)
+    parser.add_argument('--page-size',type=int,default=100)
+    parser.add_argument('--per-page',type=int,default=None,help='page size the client asks for')
+    parser.add_argument('--no-compress',action='store_true',help='serve uncompressed bodies')
+    parser.add_argument('--latency',type=float,default=0.01,help='seconds added per response')
+    parser.add_argument('--error-rate',type=float,default=0.0)
+    parser.add_argument('--throttle-rate',type=float,default=0.0)
+    parser.add_argument('--rate',type=float,default=None,help='client requests/sec (default unlimited)')
+    parser.add_argument('--burst',type=int,default=1)
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--delta',type=int,default=1000,help='new records for the incremental sync')
+    parser.add_argument('--submissions',type=int,default=200)
+    parser.add_argument('--skip-sync',action='store_true',help='skip the incremental sync (needs pyarrow)')
+    parser.add_argument('--json',help='also write the results to this file')
+    args = parser.parse_args()
+
+    data = MockData(questions=args.questions,prediction_sets=args.prediction_sets,consensus_per_question=1)
+    server = MockGfcServer(data,latency=args.latency,page_size=args.page_size,
+                           error_rate=args.error_rate,throttle_rate=args.throttle_rate,
+                           retry_after=0.1,compress=not args.no_compress).start()
+    try:
+        results = [measure('full_pull',full_pull(server,args,1),server),
+                   measure('full_pull_x{}'.format(args.workers),full_pull(server,args,args.workers),server)]
+        if not args.skip_sync:
+            results.append(measure('incremental_sync',incremental_sync(server,args),server))
+        results.append(measure('bulk_submit',bulk_submit(server,args),server))
+    finally:
+        server.stop()
+
+    columns = list(results[0])
+    print('  '.join('{:>16}'.format(c) for c in columns))
+    for row in results:
+        print('  '.join('{:>16}'.format(str(row[c])) for c in columns))
+    if args.json:
+        with open(args.json,'w') as outfile:
+            json.dump(results,outfile,indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental crowd aggregation of the human forecast stream
+@author: tiffany
+"""
+import warnings
+
+import numpy
+import pandas
+
+from iarpa_tables import flatten_prediction_sets
+
+NS_PER_DAY = 86400 * 10**9
+
+def _mean(probs, times, weights, now, options):
+    return numpy.nanmean(probs,axis=0)
+
+def _median(probs, times, weights, now, options):
+    return numpy.nanmedian(probs,axis=0)
+
+def _recency_weighted(probs, times, weights, now, options):
+    age = numpy.maximum(now - times,0) / float(NS_PER_DAY)
+    # Only relative ages matter; measuring from the newest forecast keeps old crowds
+    # from underflowing to zero weight
+    if len(age):
+        age = age - age.min()
+    w = 0.5 ** (age / options['half_life_days'])
+    return _weighted_mean(probs,w)
+
+def _extremized(probs, times, weights, now, options):
+    eps = options['clip']
+    p = numpy.clip(probs,eps,1-eps)
+    logit = numpy.log(p) - numpy.log1p(-p)
+    return 1.0 / (1.0 + numpy.exp(-options['extremize'] * numpy.nanmean(logit,axis=0)))
+
+def _skill_weighted(probs, times, weights, now, options):
+    return _weighted_mean(probs,weights)
+
+def _weighted_mean(probs,w):
+    present = ~numpy.isnan(probs)
+    w = numpy.where(present,w[:,None],0.0)
+    total = w.sum(axis=0)
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        return numpy.where(total > 0,(numpy.nan_to_num(probs) * w).sum(axis=0) / total,numpy.nan)
+
+# Every method maps (probs[forecaster, answer], forecast times, skill weights, now,
+# options) to one probability per answer.  Add to this to define new methods.
+METHODS = {'mean':_mean,
+           'median':_median,
+           'recency_weighted':_recency_weighted,
+           'extremized_log_odds':_extremized,
+           'skill_weighted':_skill_weighted}
+
+DEFAULT_OPTIONS = {'half_life_days':3.0, 'extremize':2.5, 'clip':0.01}
+
+# Methods whose result still changes with 'now' when every forecast is in the past
+# (e.g. a fixed look-back window); they are redone whenever 'now' moves.
+# recency_weighted isn't one: exponential decay scales every forecaster's weight by
+# the same factor as the clock moves.
+CLOCK_METHODS = set()
+
+class AggregationEngine(object):
+    """
+        Keeps each forecaster's latest forecast per question and turns the crowd into
+        one forecast per configured method.
+
+        update() only touches the questions in the new batch, overwriting a
+        forecaster's row when a newer prediction set arrives, and aggregate() only
+        recomputes questions that changed.  Moving 'now' forward doesn't change the
+        recency weighted forecast, so a new 'now' only redoes CLOCK_METHODS.  Each
+        question is aggregated by all methods from the same forecaster x answer matrix.
+
+        Only each forecaster's latest forecast is kept, so the crowd can't be rebuilt
+        as of an earlier time: aggregate() refuses a 'now' before a question's newest
+        forecast.  Backtest with iarpa_index.ForecastIndex.as_of instead.
+    """
+    def __init__(self,methods=None,options=None,skill_weights=None):
+        """
+            methods - <list> - Names from METHODS to compute
+                Default: all of them
+
+            options - <dictionary> - Overrides for DEFAULT_OPTIONS
+                Default: None
+
+            skill_weights - <dictionary> - membership_guid -> weight for 'skill_weighted'.
+                                           Forecasters without a weight get 1.0.
+                Default: None
+        """
+        self.methods = list(methods or METHODS)
+        self.options = dict(DEFAULT_OPTIONS)
+        self.options.update(options or {})
+        self.skill_weights = dict(skill_weights or {})
+        self._questions = {}
+        self._results = {} # question_id -> (methods x answers array, 'now' it was computed for)
+        self._dirty = set()
+        self._newest = numpy.iinfo(numpy.int64).min # newest forecast time in any question
+
+    def update(self,prediction_sets):
+        """
+            Fold in new prediction sets (API records, a page from
+            iter_human_forecasts(batches=True), or a flatten_prediction_sets table).
+
+             Output:
+            The set of question ids whose crowd changed
+        """
+        flat = prediction_sets
+        if not (isinstance(flat,pandas.DataFrame) and 'answer_id' in flat):
+            flat = flatten_prediction_sets(prediction_sets)
+        if flat.empty:
+            return set()
+
+        touched = set()
+        for question_id, rows in flat.groupby('question_id'):
+            self._merge(int(question_id),rows)
+            touched.add(int(question_id))
+        self._dirty |= touched
+        return touched
+
+    def _merge(self,question_id,rows):
+        # One row per prediction set, the forecaster's newest set last
+        new = rows.pivot_table(index=['membership_guid','created_at','prediction_set_id'],
+                               columns='answer_id',values='forecasted_probability',
+                               aggfunc='last',observed=True).sort_index(level='created_at')
+        new = new[~new.index.get_level_values('membership_guid').duplicated(keep='last')]
+        guids = new.index.get_level_values('membership_guid').astype(str)
+        times = new.index.get_level_values('created_at').to_numpy(dtype=numpy.int64)
+
+        q = self._questions.get(question_id)
+        if q is None:
+            q = {'guids':pandas.Index([],dtype=object),'answer_ids':numpy.array([],dtype=numpy.int64),
+                 'probs':numpy.zeros((0,0)),'times':numpy.zeros(0,dtype=numpy.int64)}
+            self._questions[question_id] = q
+
+        # Widen the matrix if the batch mentions answers we haven't seen
+        answer_ids = numpy.union1d(q['answer_ids'],new.columns.to_numpy(dtype=numpy.int64))
+        if len(answer_ids) != len(q['answer_ids']):
+            probs = numpy.full((len(q['guids']),len(answer_ids)),numpy.nan)
+            probs[:,numpy.searchsorted(answer_ids,q['answer_ids'])] = q['probs']
+            q['probs'] = probs
+            q['answer_ids'] = answer_ids
+
+        # Add rows for forecasters we haven't seen
+        unseen = guids.difference(q['guids'])
+        if len(unseen):
+            q['guids'] = q['guids'].append(unseen)
+            q['probs'] = numpy.vstack([q['probs'],numpy.full((len(unseen),len(answer_ids)),numpy.nan)])
+            q['times'] = numpy.concatenate([q['times'],numpy.full(len(unseen),numpy.iinfo(numpy.int64).min)])
+
+        rows_at = q['guids'].get_indexer(guids)
+        newer = times >= q['times'][rows_at]
+        values = numpy.full((len(new),len(answer_ids)),numpy.nan)
+        values[:,numpy.searchsorted(answer_ids,new.columns.to_numpy(dtype=numpy.int64))] = new.to_numpy()
+        q['probs'][rows_at[newer]] = values[newer]
+        q['times'][rows_at[newer]] = times[newer]
+        self._newest = max(self._newest,int(times.max()))
+
+    def set_skill_weights(self,skill_weights):
+        """
+            Replace the forecaster weights used by 'skill_weighted'.
+        """
+        self.skill_weights = dict(skill_weights)
+        self._dirty |= set(self._questions)
+
+    def aggregate(self,question_ids=None,now=None):
+        """
+            Crowd forecasts for every configured method.
+
+            question_ids - <list> - Limit the output to these questions
+                Default: None (every question seen so far)
+
+            now - <datetime> - Reference time for recency weighting.  Raises ValueError
+                               if it is before the newest forecast on one of the
+                               questions, since those forecasts would leak into it.
+                Default: the current time
+
+             Output:
+            A DataFrame with columns method, question_id, answer_id and value.  Each
+            method's values for a question sum to 1.
+        """
+        now = pandas.Timestamp(now if now is not None else pandas.Timestamp.now(tz='UTC'))
+        if now.tzinfo is None:
+            now = now.tz_localize('UTC')
+        now = now.value
+        clock_methods = [i for i, name in enumerate(self.methods) if name in CLOCK_METHODS]
+
+        if question_ids is None:
+            question_ids = sorted(self._questions)
+        question_ids = [q for q in question_ids if q in self._questions]
+        if now < self._newest:
+            late = [q for q in question_ids if self._questions[q]['times'].max() > now]
+            if late:
+                raise ValueError("'now' is before the latest forecasts on questions {}; the "
+                                 "engine only keeps each forecaster's latest forecast, so use "
+                                 "ForecastIndex.as_of to backtest".format(late))
+        for question_id in question_ids:
+            if question_id in self._dirty or question_id not in self._results:
+                self._results[question_id] = (self._aggregate_question(question_id,now),now)
+                self._dirty.discard(question_id)
+            elif clock_methods:
+                values, then = self._results[question_id]
+                if now != then:
+                    values = values.copy()
+                    values[clock_methods] = self._aggregate_question(question_id,now,clock_methods)
+                    self._results[question_id] = (values,now)
+
+        if not question_ids:
+            return pandas.DataFrame(columns=['method','question_id','answer_id','value'])
+        frames = []
+        for question_id in question_ids:
+            values, _ = self._results[question_id]
+            answer_ids = self._questions[question_id]['answer_ids']
+            frames.append(pandas.DataFrame({'method':numpy.repeat(self.methods,len(answer_ids)),
+                                            'question_id':question_id,
+                                            'answer_id':numpy.tile(answer_ids,len(self.methods)),
+                                            'value':values.ravel()}))
+        return pandas.concat(frames,ignore_index=True)
+
+    def _aggregate_question(self,question_id,now,methods=None):
+        """
+            One row of probabilities per method (the positions in self.methods given by
+            'methods', default all of them).
+        """
+        if methods is None:
+            methods = range(len(self.methods))
+        q = self._questions[question_id]
+        weights = numpy.array([self.skill_weights.get(g,1.0) for g in q['guids']],dtype=numpy.float64)
+        out = numpy.empty((len(methods),len(q['answer_ids'])))
+        # Answers nobody currently forecasts come out as NaN (with a warning); they
+        # get no probability
+        with numpy.errstate(all='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            for row, i in enumerate(methods):
+                out[row] = METHODS[self.methods[i]](q['probs'],q['times'],weights,now,self.options)
+            out = numpy.nan_to_num(out)
+            out = out / out.sum(axis=1,keepdims=True)
+        return out
+
+    def predictions(self,question_id,method,now=None):
+        """
+            One method's forecast for a question in the form submit_forecast expects:
+            [{'answer_id': <Integer>, 'value': <Decimal>}, ...]
+        """
+        df = self.aggregate([question_id],now=now)
+        df = df[df['method'] == method]
+        return [{'answer_id':int(a),'value':float(v)} for a, v in zip(df['answer_id'],df['value'])]
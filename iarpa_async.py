@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio version of the GF Challenge API client
+@author: tiffany
+"""
+import asyncio
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import iarpa_json
+from iarpa_functions import GfcApi, GfcApiError, RateLimiter, _retry_after_seconds
+
+class AsyncRateLimiter(RateLimiter):
+    """
+        The same token bucket as RateLimiter, but acquire() is a coroutine that
+        awaits its turn instead of blocking the event loop.
+    """
+    async def acquire(self):
+        """
+            Wait for a token.  Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            wait, epoch = self._reserve()
+            if wait <= 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+            if epoch == self._epoch:
+                return waited
+
+class AsyncGfcApi(GfcApi):
+    """
+        An asyncio client for the IARPA Geopolitical Forecasting Challenge API.
+
+        It has the same methods as GfcApi, but each one is a coroutine (and the
+        iter_* methods are async generators), so question, forecast and consensus
+        pulls can overlap with submissions on a single event loop.  Requests go
+        through one pooled aiohttp session and an AsyncRateLimiter.
+
+        Use it as an async context manager, or call close() when finished:
+
+            async with AsyncGfcApi(token,server) as gf:
+                ifps = await gf.get_questions()
+    """
+    def __init__(self,token,server,proxy=None,verbose=False,page_workers=1,page_retries=2,
+                 rate_limiter=None,hooks=None,per_page=None,pool_size=10):
+        """
+            Takes the same arguments as GfcApi, plus
+
+            pool_size - <integer> - Maximum number of open connections in the session's pool
+                Default: 10
+
+            rate_limiter must be an AsyncRateLimiter if given.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncGfcApi requires the aiohttp package")
+        if rate_limiter is None:
+            rate_limiter = AsyncRateLimiter(rate=1.0,burst=1) #one call per second
+
+        GfcApi.__init__(self,token,server,proxy=proxy,verbose=verbose,
+                        page_workers=page_workers,page_retries=page_retries,
+                        rate_limiter=rate_limiter,hooks=hooks,per_page=per_page)
+        self.pool_size = pool_size
+
+    def _new_session(self):
+        # The aiohttp session is created on first use, inside the running loop
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.sess is not None:
+            await self.sess.close()
+            self.sess = None
+
+    async def get_questions(self, status=None, created_before=None, created_after=None,
+                  sort='published_at', updated_before=None, updated_after=None, per_page=None):
+        """
+            See GfcApi.get_questions
+        """
+        params = self._questions_params(status, created_before, created_after, sort,
+                                        updated_before, updated_after, per_page)
+        return await self._get_pages(url=self.questions_url,section='questions',params=params)
+
+    async def get_human_forecasts(self, question_id=None, created_before=None, created_after=None,
+                                  updated_before=None, updated_after=None, per_page=None):
+        """
+            See GfcApi.get_human_forecasts
+        """
+        params = self._human_forecasts_params(question_id, created_before, created_after,
+                                              updated_before, updated_after, per_page)
+        return await self._get_pages(url=self.prediction_sets_url,section='prediction_sets',
+                                     params=params)
+
+    async def iter_human_forecasts(self, question_id=None, created_before=None, created_after=None,
+                                   updated_before=None, updated_after=None, batches=False, per_page=None):
+        """
+            See GfcApi.iter_human_forecasts.  Use with 'async for'.
+        """
+        params = self._human_forecasts_params(question_id, created_before, created_after,
+                                              updated_before, updated_after, per_page)
+        async for item in self._iter_section(url=self.prediction_sets_url,params=params,
+                                             section='prediction_sets',batches=batches):
+            yield item
+
+    async def get_consensus_histories(self, question_id=None, created_before=None, created_after=None,
+                                      updated_before=None, updated_after=None, per_page=None):
+        """
+            See GfcApi.get_consensus_histories
+        """
+        params = self._consensus_histories_params(question_id, created_before, created_after,
+                                                  updated_before, updated_after, per_page)
+        return await self._get_pages(url=self.consensus_histories_url,section='consensus_histories',
+                                     params=params)
+
+    async def iter_consensus_histories(self, question_id=None, created_before=None, created_after=None,
+                                       updated_before=None, updated_after=None, batches=False, per_page=None):
+        """
+            See GfcApi.iter_consensus_histories.  Use with 'async for'.
+        """
+        params = self._consensus_histories_params(question_id, created_before, created_after,
+                                                  updated_before, updated_after, per_page)
+        async for item in self._iter_section(url=self.consensus_histories_url,params=params,
+                                             section='consensus_histories',batches=batches):
+            yield item
+
+    async def submit_forecast(self,question_id,method_name,predictions):
+        """
+            See GfcApi.submit_forecast
+        """
+        params = self._submit_params(question_id,method_name,predictions)
+        return await self._post(self.external_prediction_sets_url,params)
+
+    async def submit_forecasts(self,jobs,questions=None,workers=4,retries=2):
+        """
+            See GfcApi.submit_forecasts.  Validated jobs are submitted as tasks, at most
+            'workers' in flight at once, all sharing this client's rate limiter.
+        """
+        from iarpa_submit import _job_tuple, _report, validate_forecasts
+
+        jobs = [_job_tuple(j) for j in jobs]
+        checked = validate_forecasts(jobs,questions)
+        slots = asyncio.Semaphore(workers)
+
+        async def submit(job,predictions):
+            question_id, method_name, _ = job
+            attempts = 0
+            async with slots:
+                while True:
+                    attempts+=1
+                    try:
+                        resp = await self.submit_forecast(question_id,method_name,predictions)
+                    except (aiohttp.ClientError,asyncio.TimeoutError) as err:
+                        if attempts > retries:
+                            return 'failed', attempts, str(err), None
+                        await asyncio.sleep(min(2**attempts,30))
+                        continue
+                    if resp is None:
+                        # The response wasn't json
+                        if attempts > retries:
+                            return 'failed', attempts, 'response was not json', None
+                        await asyncio.sleep(min(2**attempts,30))
+                        continue
+                    if isinstance(resp,dict) and 'errors' in resp:
+                        return 'rejected', attempts, str(resp['errors']), resp
+                    return 'submitted', attempts, None, resp
+
+        async def invalid(error):
+            return 'invalid', 0, error, None
+
+        results = await asyncio.gather(*[submit(job,predictions) if error is None else invalid(error)
+                                         for job, (predictions, error) in zip(jobs,checked)])
+        return _report(jobs,list(results))
+
+    async def _get_pages(self,url,params,section):
+        """
+            See GfcApi._get_pages
+        """
+        all_results = []
+        try:
+            async for this_batch in self.iter_pages(url=url,params=params,section=section):
+                all_results.extend(this_batch)
+        except GfcApiError as err:
+            if isinstance(err.results,dict) and 'errors' in err.results:
+                print(err.results['errors'])
+            return err.results
+
+        return all_results
+
+    async def iter_pages(self,url,params,section,workers=None,start_page=1):
+        """
+            Async generator version of GfcApi.iter_pages.  With more than one worker the
+            pages after start_page are requested as concurrent tasks (still within the
+            rate limit) and yielded in page order.
+        """
+        params = self._page_params(params)
+        if not self.hooks:
+            async for this_batch in self._iter_pages(url,params,section,workers,start_page):
+                yield this_batch
+            return
+
+        endpoint = self._endpoint(url)
+        started = time.perf_counter()
+        pages = 0
+        records = 0
+        completed = False
+        try:
+            async for this_batch in self._iter_pages(url,params,section,workers,start_page):
+                self._emit('page',endpoint=endpoint,page=start_page+pages,records=len(this_batch))
+                pages+=1
+                records+=len(this_batch)
+                yield this_batch
+            completed = True
+        finally:
+            self._emit('query',endpoint=endpoint,pages=pages,records=records,
+                       seconds=time.perf_counter()-started,completed=completed)
+
+    async def _iter_pages(self,url,params,section,workers,start_page):
+        if self.verbose:
+            print('Get Pages for {}'.format(url))
+            print(params)
+        if workers is None:
+            workers = self.page_workers
+
+        results, maxPage = await self._get_page(url,params,start_page)
+        yield results[section]
+
+        if workers <= 1 or maxPage <= start_page+1:
+            page = start_page+1
+            while page <= maxPage:
+                results, maxPage = await self._get_page(url,params,page)
+                yield results[section]
+                page+=1
+            return
+
+        window = 2*workers
+        pending = {}
+        next_page = start_page+1
+        try:
+            for page in range(start_page+1,maxPage+1):
+                while next_page <= maxPage and next_page < page+window:
+                    pending[next_page] = asyncio.ensure_future(self._get_page(url,params,next_page))
+                    next_page+=1
+                results, _ = await pending.pop(page)
+                yield results[section]
+        finally:
+            for task in pending.values():
+                task.cancel()
+
+    async def _iter_section(self,url,params,section,batches=False):
+        async for this_batch in self.iter_pages(url=url,params=params,section=section):
+            if batches:
+                yield this_batch
+            else:
+                for record in this_batch:
+                    yield record
+
+    async def _get_page(self,url,params,page):
+        """
+            See GfcApi._get_page
+        """
+        params = dict(params)
+        params['page'] = page
+        attempt = 0
+        while True:
+            try:
+                status, headers, results = await self._get(url=url,params=params)
+            except (aiohttp.ClientError,asyncio.TimeoutError) as err:
+                if attempt >= self.page_retries:
+                    raise GfcApiError(None)
+                if self.verbose:
+                    print("{}: page {} failed ({}), retrying".format(time.ctime(),page,err))
+                attempt+=1
+                continue
+
+            if isinstance(results,(list,dict)):
+                if 'errors' in results and status < 500 and status != 429:
+                    raise GfcApiError(results)
+                if 'errors' not in results:
+                    return results, int(headers.get('X-Total-Page-Count',0))
+
+            if attempt >= self.page_retries:
+                if self.verbose:
+                    print("PROBLEM")
+                raise GfcApiError(results)
+            if self.verbose:
+                print("{}: page {} returned status {}, retrying".format(time.ctime(),page,status))
+            attempt+=1
+
+    async def _get(self,url,params):
+        """
+            Authenticated, rate limited GET.  Returns the status code, the response headers
+            and the decoded json (None if the body isn't json).
+        """
+        # aiohttp only accepts string query values
+        params = {k:str(v) for k,v in params.items()}
+        if self.verbose:
+            print("{}: GETTING {}".format(time.ctime(),url))
+            print("\tArgs: {}".format(params))
+        return await self._send('GET',url,params=params)
+
+    async def _post(self,url,params):
+        """
+            Authenticated, rate limited POST.  Returns the json response.
+        """
+        if self.verbose:
+            print("{}: POSTING {}".format(time.ctime(),url))
+            print("\tArgs: {}".format(params))
+        status, headers, results = await self._send('POST',url,json=params)
+        return results
+
+    async def _send(self,method,url,**kwargs):
+        """
+            See GfcApi._send
+        """
+        if self.sess is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,keepalive_timeout=60)
+            self.sess = aiohttp.ClientSession(connector=connector)
+        headers={'Authorization':'Bearer ' + self.token} #This is needed to authenticate
+        proxy = None
+        if self.proxy:
+            proxy = self.proxy.get('https' if url.startswith('https') else 'http')
+
+        attempt = 0
+        waited = 0.0
+        while True:
+            wait = await self.rate_limiter.acquire()
+            waited += wait
+            if wait and self.verbose:
+                print("{}: Slept {:.2f}s for rate limit".format(time.ctime(),wait))
+            sent = time.perf_counter()
+            async with self.sess.request(method,url,headers=headers,proxy=proxy,**kwargs) as resp:
+                status = resp.status
+                resp_headers = resp.headers
+                body = await resp.read()
+            if self.hooks:
+                self._emit('request',endpoint=self._endpoint(url),method=method,status=status,
+                           seconds=time.perf_counter()-sent,bytes=len(body),wait=waited,
+                           throttled=status == 429)
+                waited = 0.0
+            if status != 429 or attempt >= self.max_throttle_retries:
+                break
+            retry_after = _retry_after_seconds(resp_headers.get('Retry-After'))
+            if self.verbose:
+                print("{}: Throttled, backing off {}".format(time.ctime(),retry_after))
+            self.rate_limiter.backoff(retry_after)
+            attempt+=1
+
+        if status != 429:
+            self.rate_limiter.success()
+        decode_started = time.perf_counter()
+        try:
+            results = iarpa_json.loads(body)
+        except ValueError:
+            results = None
+        if self.hooks:
+            self._emit('decode',endpoint=self._endpoint(url),seconds=time.perf_counter()-decode_started)
+        return status, resp_headers, results
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for GfcApi GET responses
+@author: tiffany
+"""
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+# Response headers worth keeping with a cached body
+KEPT_HEADERS = ('Content-Type','ETag','Last-Modified','X-Total-Page-Count')
+
+class CachedResponse(object):
+    """
+        Just enough of requests.Response for _get's callers (status_code, headers,
+        content, iter_content(), json()).
+    """
+    def __init__(self,status_code,headers,content):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.from_cache = True
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def iter_content(self,chunk_size=1):
+        for i in range(0,len(self.content),chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def json(self):
+        return json.loads(self.content)
+
+class ResponseCache(object):
+    """
+        A SQLite-backed cache of GET responses keyed by URL and normalized query
+        parameters (the Authorization header is never part of the key).
+
+        Entries are fresh for 'ttl' seconds.  After that GfcApi revalidates them with
+        If-None-Match / If-Modified-Since and a 304 refreshes the entry without
+        re-downloading the body.  A query whose created_before is in the past asks
+        for a window of history that can't gain new records, so it never expires.
+        When the cache grows past 'max_bytes' the least recently used entries are
+        dropped.
+    """
+    def __init__(self,path,ttl=3600,max_bytes=500*1024*1024):
+        """
+            path - <string> - SQLite file to keep the cache in
+
+            ttl - <float> - Seconds a response is served without revalidating
+                Default: 3600
+
+            max_bytes - <integer> - Total body size the cache is allowed to hold
+                Default: 500MB
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                url TEXT,
+                                status INTEGER,
+                                headers TEXT,
+                                body BLOB,
+                                size INTEGER,
+                                stored_at REAL,
+                                last_used REAL,
+                                immutable INTEGER)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._db.commit()
+
+    def lookup(self,url,params):
+        """
+            Returns (response, fresh) for a cached query, or (None, False) on a miss.
+            A stale response is returned so its validators can be used in a
+            conditional request.
+        """
+        key = cache_key(url,params)
+        with self._lock:
+            row = self._db.execute('SELECT status, headers, body, stored_at, immutable '
+                                   'FROM responses WHERE key=?',(key,)).fetchone()
+            if row is None:
+                return None, False
+            self._db.execute('UPDATE responses SET last_used=? WHERE key=?',(time.time(),key))
+            self._db.commit()
+        status, headers, body, stored_at, immutable = row
+        fresh = bool(immutable) or (time.time() - stored_at) < self.ttl
+        return CachedResponse(status,json.loads(headers),body), fresh
+
+    def store(self,url,params,resp):
+        """
+            Cache a successful response.
+        """
+        if resp.status_code != 200:
+            return
+        key = cache_key(url,params)
+        headers = {h:resp.headers[h] for h in KEPT_HEADERS if h in resp.headers}
+        body = resp.content
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?,?)',
+                             (key,url,resp.status_code,json.dumps(headers),body,len(body),
+                              now,now,int(is_immutable(params))))
+            self._evict()
+            self._db.commit()
+
+    def refresh(self,url,params):
+        """
+            Mark a cached response as revalidated (the server answered 304).
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('UPDATE responses SET stored_at=?, last_used=? WHERE key=?',
+                             (now,now,cache_key(url,params)))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM responses '
+                                          'ORDER BY last_used').fetchall():
+            self._db.execute('DELETE FROM responses WHERE key=?',(key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+def cache_key(url,params):
+    """
+        Hash of the URL and the query parameters in a canonical order.
+    """
+    normalized = json.dumps(sorted((str(k),str(v)) for k,v in (params or {}).items()))
+    return hashlib.sha256((url + '?' + normalized).encode('utf-8')).hexdigest()
+
+def is_immutable(params):
+    """
+        True if the query only covers records created before a time that has passed.
+    """
+    created_before = (params or {}).get('created_before')
+    if not created_before:
+        return False
+    try:
+        bound = datetime.datetime.fromisoformat(str(created_before).replace('Z','+00:00'))
+    except ValueError:
+        return False
+    if bound.tzinfo is None:
+        bound = bound.replace(tzinfo=datetime.timezone.utc)
+    return bound < datetime.datetime.now(datetime.timezone.utc)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent catalog of IFPs with delta sync and id indexes
+@author: tiffany
+"""
+import datetime
+import json
+import os
+
+class QuestionCatalog(object):
+    """
+        Every IFP we have seen, kept on disk as JSON and indexed by question id and by
+        answer id.
+
+        The first sync() downloads all questions; after that only questions updated
+        since the newest updated_at in the catalog are requested, and sync() reports
+        what changed:
+
+            {'new': [ifp, ...],
+             'clarified': [ifp, ...],          # clarifications differ from before
+             'status_changed': [(ifp, old, new), ...],
+             'updated': [ifp, ...]}            # everything the delta returned
+    """
+    def __init__(self,path,overlap=datetime.timedelta(seconds=60)):
+        """
+            path - <string> - JSON file the catalog is kept in
+
+            overlap - <timedelta> - How far before the newest updated_at each delta
+                                    query starts, to cover clock skew
+                Default: 60 seconds
+        """
+        self.path = path
+        self.overlap = overlap
+        self.by_id = {}
+        self.by_answer_id = {}
+        self.watermark = None
+        if os.path.isfile(path):
+            with open(path) as infile:
+                saved = json.load(infile)
+            self.watermark = saved.get('watermark')
+            for ifp in saved.get('questions',[]):
+                self._index(ifp)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self,question_id):
+        return question_id in self.by_id
+
+    def get(self,question_id):
+        """
+            The IFP with this id, or None.
+        """
+        return self.by_id.get(question_id)
+
+    def answer(self,answer_id):
+        """
+            The (ifp, answer) pair an answer id belongs to, or (None, None).
+        """
+        return self.by_answer_id.get(answer_id,(None,None))
+
+    def questions(self,status=None):
+        """
+            All IFPs, or only those whose state/status is 'status', in id order.
+        """
+        ifps = [self.by_id[q] for q in sorted(self.by_id)]
+        if status is not None:
+            ifps = [q for q in ifps if question_status(q) == status]
+        return ifps
+
+    def sync(self,gf):
+        """
+            Bring the catalog up to date with one delta query (or a full download the
+            first time), save it, and return the changes.
+        """
+        if self.watermark is None:
+            ifps = gf.get_questions(status='all')
+        else:
+            since = _parse_time(self.watermark) - self.overlap
+            ifps = gf.get_questions(status='all',updated_after=since)
+        if isinstance(ifps,dict) or ifps is None:
+            raise ValueError("Question sync failed: {}".format(ifps))
+
+        changes = self.apply(ifps)
+        self.save()
+        return changes
+
+    def apply(self,ifps):
+        """
+            Merge IFPs into the catalog and return the changes (see the class docstring).
+        """
+        changes = {'new':[],'clarified':[],'status_changed':[],'updated':list(ifps)}
+        for ifp in ifps:
+            old = self.by_id.get(ifp['id'])
+            if old is None:
+                changes['new'].append(ifp)
+            else:
+                if (old.get('clarifications') or []) != (ifp.get('clarifications') or []):
+                    changes['clarified'].append(ifp)
+                if question_status(old) != question_status(ifp):
+                    changes['status_changed'].append((ifp,question_status(old),question_status(ifp)))
+                for answer in old.get('answers') or []:
+                    self.by_answer_id.pop(answer['id'],None)
+            self._index(ifp)
+            stamp = ifp.get('updated_at') or ifp.get('created_at')
+            if stamp and (self.watermark is None or _parse_time(stamp) > _parse_time(self.watermark)):
+                self.watermark = stamp
+        return changes
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp,'w') as outfile:
+            json.dump({'watermark':self.watermark,'questions':self.questions()},outfile)
+        os.replace(tmp,self.path)
+
+    def _index(self,ifp):
+        self.by_id[ifp['id']] = ifp
+        for answer in ifp.get('answers') or []:
+            self.by_answer_id[answer['id']] = (ifp,answer)
+
+def question_status(ifp):
+    return ifp.get('state',ifp.get('status'))
+
+def _parse_time(stamp):
+    # The API's timestamps end in 'Z'; stick to the standard library here so that
+    # loading the catalog doesn't pull in pandas
+    return datetime.datetime.fromisoformat(stamp.replace('Z','+00:00'))
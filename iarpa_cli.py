@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line interface for pulling GF Challenge data, submitting and scoring.
+
+    python iarpa_cli.py sync questions
+    python iarpa_cli.py sync forecasts
+    python iarpa_cli.py sync consensus
+    python iarpa_cli.py submit forecasts.json
+    python iarpa_cli.py score --forecasts my_forecasts.csv
+    python iarpa_cli.py watch --pipeline my_methods:forecast
+
+Settings come from, in increasing order of precedence, the config file, the
+environment and the command line:
+
+    config file (--config, $GFC_CONFIG or ~/.config/gfc/config.ini)
+
+        [gfc]
+        instance = production
+        data_dir = ~/forecasting_challenge
+
+        [production]
+        server = https://api.iarpagfchallenge.com
+        token = <your token>
+
+        [staging]
+        server = https://api.gfc-staging.com
+        token = <your token>
+
+    environment: GFC_INSTANCE, GFC_DATA_DIR, GFC_SERVER, GFC_TOKEN
+
+Only the standard library is imported up front; pandas and the API client are
+loaded by the subcommands that need them, so e.g. a cron job checking for new
+questions doesn't pay for pandas.
+@author: tiffany
+"""
+import argparse
+import configparser
+import json
+import os
+import sys
+
+DEFAULT_CONFIG = os.path.join('~','.config','gfc','config.ini')
+
+SERVERS = {'production':'https://api.iarpagfchallenge.com',
+           'staging':'https://api.gfc-staging.com'}
+
+# sync subcommand target -> SyncEngine endpoint
+SYNC_TARGETS = {'forecasts':'prediction_sets',
+                'consensus':'consensus_histories'}
+
+def load_config(path=None,instance=None,data_dir=None):
+    """
+        Work out the instance, server, token and data directory.
+
+         Output:
+        A dictionary with keys instance, server, token and data_dir
+    """
+    path = os.path.expanduser(path or os.environ.get('GFC_CONFIG') or DEFAULT_CONFIG)
+    parser = configparser.ConfigParser()
+    parser.read(path) # a missing file is just an empty config
+
+    instance = instance or os.environ.get('GFC_INSTANCE') or parser.get('gfc','instance',fallback='production')
+    section = parser[instance] if parser.has_section(instance) else {}
+    config = {'instance':instance,
+              'server':os.environ.get('GFC_SERVER') or section.get('server') or SERVERS.get(instance),
+              'token':os.environ.get('GFC_TOKEN') or section.get('token'),
+              'data_dir':data_dir or os.environ.get('GFC_DATA_DIR') or parser.get('gfc','data_dir',fallback='.')}
+    config['data_dir'] = os.path.expanduser(config['data_dir'])
+    return config
+
+def make_client(config,verbose=False):
+    import iarpa_functions as iarpa
+
+    if not config['token'] or not config['server']:
+        raise SystemExit("No API token/server for instance '{}'; set GFC_TOKEN and GFC_SERVER "
+                         "or add them to the config file".format(config['instance']))
+    return iarpa.GfcApi(config['token'],config['server'],verbose=verbose)
+
+def catalog_path(config):
+    return os.path.join(config['data_dir'],'questions_catalog.json')
+
+def store_path(config):
+    return os.path.join(config['data_dir'],'store')
+
+def cmd_sync(args,config):
+    if not os.path.isdir(config['data_dir']):
+        os.makedirs(config['data_dir'])
+    gf = make_client(config,args.verbose)
+
+    if args.target == 'questions':
+        from iarpa_catalog import QuestionCatalog
+
+        catalog = QuestionCatalog(catalog_path(config))
+        try:
+            changes = catalog.sync(gf)
+        except ValueError as err:
+            print(err)
+            return 1
+        print("We have {} IFPs ({} new, {} clarified, {} changed status)".format(
+            len(catalog),len(changes['new']),len(changes['clarified']),len(changes['status_changed'])))
+        for ifp in changes['new'] + changes['clarified']:
+            print_ifp(ifp)
+        for ifp, old, new in changes['status_changed']:
+            print("IFP {} went from {} to {}".format(ifp['id'],old,new))
+        return 0
+
+    from iarpa_store import LocalStore
+    from iarpa_sync import SyncEngine
+
+    endpoint = SYNC_TARGETS[args.target]
+    sync = SyncEngine(gf,LocalStore(store_path(config)))
+    if args.full:
+        sync.reset(endpoint)
+    written = sync.sync(endpoint)
+    print("Wrote {} {} (synced through {})".format(written,endpoint,sync.watermark(endpoint)))
+    return 0
+
+def cmd_submit(args,config):
+    from iarpa_catalog import QuestionCatalog
+
+    with open(args.path) as infile:
+        jobs = json.load(infile)
+    catalog = QuestionCatalog(catalog_path(config))
+    questions = catalog.by_id if len(catalog) else None
+
+    if args.dry_run:
+        from iarpa_submit import validate_forecasts
+
+        failed = 0
+        for job, (_, error) in zip(jobs,validate_forecasts(jobs,questions)):
+            if error:
+                failed += 1
+                print("{} / {}: {}".format(_field(job,0,'question_id'),_field(job,1,'method_name'),error))
+        print("{} of {} forecasts are valid".format(len(jobs)-failed,len(jobs)))
+        return 1 if failed else 0
+
+    gf = make_client(config,args.verbose)
+    report = gf.submit_forecasts(jobs,questions=questions,workers=args.workers)
+    print(report[['question_id','method_name','status','attempts','error']].to_string(index=False))
+    return 0 if (report['status'] == 'submitted').all() else 1
+
+def cmd_score(args,config):
+    import pandas
+
+    from iarpa_catalog import QuestionCatalog
+    from iarpa_scoring import resolutions, score_parallel, summarize
+    from iarpa_store import LocalStore
+
+    resolved = resolutions(QuestionCatalog(catalog_path(config)).questions())
+    if args.question_id:
+        resolved = {q:r for q, r in resolved.items() if q in set(args.question_id)}
+    if not resolved:
+        print("No resolved IFPs to score; run 'sync questions' first")
+        return 1
+
+    consensus = None
+    store = LocalStore(store_path(config))
+    if not args.no_consensus and not store.is_empty('consensus_histories'):
+        consensus = store.load('consensus_histories',question_ids=list(resolved))
+    forecasts = None
+    if args.forecasts:
+        if args.forecasts.endswith('.json'):
+            forecasts = pandas.read_json(args.forecasts)
+        else:
+            forecasts = pandas.read_csv(args.forecasts)
+
+    scores = score_parallel(resolved,forecasts,consensus,workers=args.workers)
+    if scores.empty:
+        print("Nothing to score")
+        return 1
+    _, per_method = summarize(scores)
+    print(per_method.to_string())
+    return 0
+
+def cmd_watch(args,config):
+    import importlib
+    import signal
+
+    from iarpa_catalog import QuestionCatalog
+    from iarpa_scheduler import ReleaseScheduler
+
+    module, _, name = args.pipeline.partition(':')
+    pipeline = getattr(importlib.import_module(module),name or 'pipeline')
+    if not os.path.isdir(config['data_dir']):
+        os.makedirs(config['data_dir'])
+
+    scheduler = ReleaseScheduler(make_client(config,args.verbose),QuestionCatalog(catalog_path(config)),
+                                 pipeline,fast_interval=args.fast_interval,slow_interval=args.slow_interval)
+    signal.signal(signal.SIGTERM,lambda *_: scheduler.stop())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def print_ifp(ifp):
+    print("IFP {}: {}".format(ifp['id'],ifp['name']))
+    print("Description: {}".format(ifp['description']))
+    print("Starts: {}, Ends: {}".format(ifp['starts_at'],ifp['ends_at']))
+    print("Options:")
+    for answer in ifp['answers']:
+        print(' ({}) {}'.format(answer['id'],answer['name']))
+    if ifp.get('clarifications'):
+        print('Clarifications:')
+        print(ifp['clarifications'])
+    print("")
+
+def _field(job,i,key):
+    return job[key] if isinstance(job,dict) else job[i]
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Pull GF Challenge data, submit forecasts and score them')
+    parser.add_argument('--config',help='config file (default $GFC_CONFIG or {})'.format(DEFAULT_CONFIG))
+    parser.add_argument('--instance',help="'production', 'staging' or another section of the config file")
+    parser.add_argument('--data-dir',help='where the question catalog and the store live')
+    parser.add_argument('--verbose',action='store_true')
+    commands = parser.add_subparsers(dest='command',required=True)
+
+    sync = commands.add_parser('sync',help='pull what changed since the last sync')
+    sync.add_argument('target',choices=['questions'] + sorted(SYNC_TARGETS))
+    sync.add_argument('--full',action='store_true',help='forget the watermark and pull everything')
+    sync.set_defaults(func=cmd_sync)
+
+    submit = commands.add_parser('submit',help='validate and submit forecasts from a json file')
+    submit.add_argument('path',help='json list of {question_id, method_name, predictions}')
+    submit.add_argument('--workers',type=int,default=4)
+    submit.add_argument('--dry-run',action='store_true',help='only validate')
+    submit.set_defaults(func=cmd_submit)
+
+    score = commands.add_parser('score',help='daily Brier scores on resolved IFPs')
+    score.add_argument('--forecasts',help='csv or json with method, question_id, answer_id, value, created_at')
+    score.add_argument('--question-id',type=int,action='append',help='limit to these IFPs (repeatable)')
+    score.add_argument('--no-consensus',action='store_true',help="don't score the consensus baseline")
+    score.add_argument('--workers',type=int,default=1)
+    score.set_defaults(func=cmd_score)
+
+    watch = commands.add_parser('watch',help='poll for new IFPs and forecast them as soon as they appear')
+    watch.add_argument('--pipeline',required=True,
+                       help="module:function called with (ifps, catalog) that returns jobs to submit")
+    watch.add_argument('--fast-interval',type=float,default=10.0,help='seconds between polls in a release window')
+    watch.add_argument('--slow-interval',type=float,default=900.0,help='longest sleep outside a window')
+    watch.set_defaults(func=cmd_watch)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    config = load_config(args.config,args.instance,args.data_dir)
+    return args.func(args,config)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,174 @@ Created on Wed Mar 21 14:24:16 2018
 @author: tiffany
 """
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import iarpa_json
+
+class GfcApiError(Exception):
+    """
+        Raised by the generator interfaces (iter_pages and friends) when the API
+        returns an error message or a response that isn't json.  The decoded
+        response, if any, is kept in 'results'.
+    """
+    def __init__(self,results):
+        Exception.__init__(self,results)
+        self.results = results
+
+class RateLimiter(object):
+    """
+        A thread-safe token bucket shared by every GET and POST a client makes.
+        
+        Tokens refill continuously at 'rate' per second up to 'burst'; each call
+        spends one.  Callers reserve their token under a lock and then sleep for
+        exactly as long as it takes for that token to arrive, so a 1 request/second
+        limit costs one second per call rather than up to two.
+        
+        When the server pushes back (429 / Retry-After) call backoff(): the bucket
+        stops handing out tokens until the server's deadline has passed and the
+        rate is halved.  Tokens reserved before the backoff are void: their callers
+        reserve again when they wake, queueing behind the deadline, and later callers
+        aren't charged for them.  Each success afterwards creeps the rate back up to
+        the configured maximum.
+    """
+    def __init__(self,rate=1.0,burst=1,min_rate=0.05,recovery=0.1,max_backoff=300.0):
+        """
+            rate - <float> - Sustained requests per second.  None disables limiting.
+                Default: 1.0
+            
+            burst - <integer> - Number of requests that may be made back to back after
+                                an idle period
+                Default: 1
+            
+            min_rate - <float> - Floor for the adaptive rate after repeated backoffs
+                Default: 0.05
+            
+            recovery - <float> - Fraction of 'rate' added back after each success
+                Default: 0.1
+            
+            max_backoff - <float> - Upper bound, in seconds, on a single backoff pause
+                Default: 300.0
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.max_backoff = max_backoff
+        
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoffs = 0
+        self._epoch = 0 # bumped by backoff(), voiding the reservations made before it
+    
+    def acquire(self):
+        """
+            Wait for a token.  Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            wait, epoch = self._reserve()
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+            if epoch == self._epoch:
+                return waited
+    
+    def _reserve(self):
+        """
+            Take a token (possibly one that hasn't arrived yet).
+            
+             Output:
+            How many seconds the caller has to wait before using it, and the backoff
+            epoch it was reserved in; if a backoff happens before the wait is over, the
+            token is void and the caller must reserve again
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is None:
+                wait = max(0.0,self._blocked_until-now)
+            else:
+                self._refill(now)
+                self._tokens -= 1.0
+                # During a backoff the bucket's clock sits at the server's deadline
+                wait = max(0.0,self._last-now)
+                if self._tokens < 0:
+                    wait += -self._tokens/self.rate
+                wait = max(wait,self._blocked_until-now)
+            return wait, self._epoch
+    
+    def backoff(self,retry_after=None):
+        """
+            Register that the server refused a request.  'retry_after' is the number of
+            seconds the server asked us to wait; without one we back off exponentially.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._backoffs += 1
+            if retry_after is None:
+                retry_after = min(self.max_backoff,2.0**self._backoffs)
+            retry_after = min(self.max_backoff,max(0.0,retry_after))
+            self._blocked_until = max(self._blocked_until,now+retry_after)
+            self._epoch += 1
+            if self.rate is not None:
+                self.rate = max(self.min_rate,self.rate/2.0)
+                # Outstanding reservations are void (their callers reserve again), and
+                # nothing accrues until the deadline, where one request may go and the
+                # rest queue behind it at the new rate instead of all going at once
+                self._tokens = 1.0
+                self._last = max(self._last,self._blocked_until)
+    
+    def success(self):
+        """
+            Register an accepted request, letting the rate recover after a backoff.
+        """
+        with self._lock:
+            self._backoffs = 0
+            if self.rate is not None and self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate,self.rate+self.recovery*self.max_rate)
+    
+    def set_rate(self,rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.max_rate = rate
+            self.rate = rate
+    
+    def _refill(self,now):
+        if now <= self._last:
+            return # still before a backoff deadline
+        if self.rate is not None:
+            self._tokens = min(float(self.burst),self._tokens+(now-self._last)*self.rate)
+        self._last = now
+
+def make_session(pool_size=10,connect_retries=3,backoff=0.2):
+    """
+        A requests session tuned for the API: a connection pool of 'pool_size' kept-alive
+        connections per host, compressed responses, and transport-level retries (with
+        exponential backoff from 'backoff' seconds) when a connection can't be made or is
+        reset.  Reads are only retried for GETs, so a POST that may have reached the
+        server is never sent twice.  HTTP error statuses are left to GfcApi.
+
+        Pass the same session to several GfcApi instances to share warm connections.
+    """
+    sess = requests.Session()
+    retry = Retry(total=connect_retries,connect=connect_retries,read=connect_retries,status=0,
+                  backoff_factor=backoff,raise_on_status=False,respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=4,pool_maxsize=pool_size,max_retries=retry)
+    sess.mount('https://',adapter)
+    sess.mount('http://',adapter)
+    sess.headers['Accept-Encoding'] = 'gzip, deflate'
+    sess.headers['Connection'] = 'keep-alive'
+    return sess
 
 class GfcApi(object):
     """
@@ -14,7 +181,9 @@ class GfcApi(object):
         API.  Note that this code is for reference purposes, no warranties are expressed
         or implied.  
     """
-    def __init__(self,token,server,proxy=None,verbose=False):
+    def __init__(self,token,server,proxy=None,verbose=False,page_workers=1,page_retries=2,
+                 rate_limiter=None,cache=None,hooks=None,per_page=None,session=None,
+                 stream_pages=False):
         """
             Create an instance of an API client. This assumes you have an OAuth token.
             
@@ -41,6 +210,45 @@ class GfcApi(object):
             verbose - <boolean> - If true, we print GET and POST request URLs and params
                 Default: False
             
+            page_workers - <integer> - Number of threads used to fetch the remaining pages of a
+                                       query once the first page reports X-Total-Page-Count.
+                                       All threads share the same rate limit.
+                Default: 1 (fetch pages one at a time)
+            
+            page_retries - <integer> - Number of times a single page is re-requested after a
+                                       connection error, server error or non-json response
+                                       before the pull is abandoned
+                Default: 2
+            
+            rate_limiter - <RateLimiter> - Shared budget for every GET and POST.  Pass the same
+                                           limiter to several clients to make them share it.
+                Default: one request per second with no burst
+            
+            cache - <ResponseCache> - If given, GET responses are kept on disk (see
+                                      iarpa_cache) and repeat queries skip the network
+                                      or are revalidated with a conditional request
+                Default: None
+            
+            hooks - <list> - Callables taking (event, fields) that are told about every
+                             request, decoded page and paged query, e.g. an
+                             iarpa_metrics.MetricsRegistry
+                Default: None
+            
+            per_page - <integer> - Records to ask for per page on every paged query, so
+                                   a pull takes fewer, larger responses.  Each get_*
+                                   method's per_page overrides it.
+                Default: None (the server's page size)
+            
+            session - <requests.Session> - Session to send requests through, e.g. one
+                                           from make_session shared with other clients
+                Default: make_session() with a pool big enough for page_workers
+            
+            stream_pages - <boolean> - If true, paged queries read each response body as a
+                                       stream and decode its records one at a time
+                                       (iarpa_json.iter_response), so the raw body and
+                                       its full parse are never in memory together
+                Default: False
+            
         """
         
         self.token = token
@@ -48,11 +256,40 @@ class GfcApi(object):
         self.proxy = proxy
         self.verbose = verbose
         
-        self.sess = requests.session()
-        self.rate_limit_delay = 1 #seconds between subsequent API calls
-        self.last_call_time = 0.0 
+        self.page_workers = page_workers
+        if session is None:
+            session = self._new_session()
+        self.sess = session
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(rate=1.0,burst=1) #one call per second
+        self.rate_limiter = rate_limiter
+        self.max_throttle_retries = 5 #times a 429 is retried before it's returned
+        self.cache = cache
+        self.hooks = list(hooks or [])
+        self.page_retries = page_retries
+        self.per_page = per_page
+        self.stream_pages = stream_pages
         self.set_urls()
     
+    def _new_session(self):
+        """
+            The session used when none is passed in: a pool big enough for page_workers.
+        """
+        return make_session(pool_size=max(10,self.page_workers))
+    
+    @property
+    def rate_limit_delay(self):
+        """
+            Seconds between subsequent API calls (the inverse of the limiter's rate).
+        """
+        if self.rate_limiter.max_rate is None:
+            return 0
+        return 1.0/self.rate_limiter.max_rate
+    
+    @rate_limit_delay.setter
+    def rate_limit_delay(self,delay):
+        self.rate_limiter.set_rate(1.0/delay if delay else None)
+    
     def set_urls(self):
         if not self.server.endswith('/'):
             self.server += '/'
@@ -65,7 +302,7 @@ class GfcApi(object):
         self.questions_url = self.api_base + 'questions'
 
     def get_questions(self, status=None, created_before=None, created_after=None,
-                  sort='published_at', updated_before=None, updated_after=None):
+                  sort='published_at', updated_before=None, updated_after=None, per_page=None):
         """
             This function retrieves Individual Forecasting Problems (IFPs).
 
@@ -94,6 +331,8 @@ class GfcApi(object):
             updated_before - <datetime> - returns only questions updated before this time
             
             updated_after - <datetime> - returns only questions updated after this time
+            
+            per_page - <integer> - questions per page (see GfcApi's per_page)
                     
              Output:
             JSON representation of a list of Individual Forecasting Problems
@@ -101,25 +340,34 @@ class GfcApi(object):
         
         url = self.questions_url
         section = 'questions'
+        params = self._questions_params(status, created_before, created_after, sort,
+                                        updated_before, updated_after, per_page)
+        
+        return self._get_pages(url=url,section=section,params=params)
+    
+    def _questions_params(self, status, created_before, created_after, sort,
+                          updated_before, updated_after, per_page=None):
         params={}
         
         if created_before:
             params['created_before'] = created_before.isoformat()
         if created_after:
             params['created_after'] = created_after.isoformat()
-        if created_before:
+        if updated_before:
             params['updated_before'] = updated_before.isoformat()
-        if created_after:
+        if updated_after:
             params['updated_after'] = updated_after.isoformat()
         if status:
             params['status'] = status
         if sort:
             params['sort'] = sort  
+        if per_page:
+            params['per_page'] = per_page
         
-        return self._get_pages(url=url,section=section,params=params)
+        return params
     
     def get_human_forecasts(self, question_id=None, created_before=None, created_after=None,
-                           updated_before=None, updated_after=None):
+                           updated_before=None, updated_after=None, per_page=None):
 
         """
             This function retrieves the stream of human forecasts against IFPs.
@@ -136,6 +384,8 @@ class GfcApi(object):
             updated_before - <datetime> - returns only predictions updated before this time
             
             updated_after - <datetime> - returns only predictions updated after this time
+            
+            per_page - <integer> - records per page (see GfcApi's per_page)
                     
              Output:
             JSON representation of a list of human forecasts
@@ -143,6 +393,32 @@ class GfcApi(object):
         
         url = self.prediction_sets_url
         section = 'prediction_sets'
+        params = self._human_forecasts_params(question_id, created_before, created_after,
+                                              updated_before, updated_after, per_page)
+        
+        return self._get_pages(url=url,section=section,params=params)        
+    
+    def iter_human_forecasts(self, question_id=None, created_before=None, created_after=None,
+                             updated_before=None, updated_after=None, batches=False, per_page=None):
+        """
+            Generator version of get_human_forecasts.  Takes the same optional inputs, but
+            yields prediction sets as each page arrives instead of collecting the whole
+            history in memory first.
+            
+            batches - <boolean> - If true, yield one list of prediction sets per page
+                                  rather than individual prediction sets
+                Default: False
+        """
+        
+        url = self.prediction_sets_url
+        section = 'prediction_sets'
+        params = self._human_forecasts_params(question_id, created_before, created_after,
+                                              updated_before, updated_after, per_page)
+        
+        return self._iter_section(url=url,section=section,params=params,batches=batches)
+    
+    def _human_forecasts_params(self, question_id, created_before, created_after,
+                                updated_before, updated_after, per_page=None):
         params={}
         
         if created_before:
@@ -155,11 +431,13 @@ class GfcApi(object):
             params['updated_after'] = updated_after.isoformat()
         if question_id:
             params['question_id'] = question_id
+        if per_page:
+            params['per_page'] = per_page
         
-        return self._get_pages(url=url,section=section,params=params)        
+        return params
     
     def get_consensus_histories(self, question_id=None, created_before=None, created_after=None,
-                           updated_before=None, updated_after=None):
+                           updated_before=None, updated_after=None, per_page=None):
 
         """
             This function retrieves the consensus of human forecasts against IFPs.
@@ -182,17 +460,45 @@ class GfcApi(object):
             updated_before - <datetime> - returns only predictions updated before this time
             
             updated_after - <datetime> - returns only predictions updated after this time
+            
+            per_page - <integer> - records per page (see GfcApi's per_page)
                     
              Output:
             JSON representation of a list of human forecasts
         """
         
+        url = self.consensus_histories_url
+        section = 'consensus_histories'
+        params = self._consensus_histories_params(question_id, created_before, created_after,
+                                                  updated_before, updated_after, per_page)
+        
+        return self._get_pages(url=url,section=section,params=params)   
+    
+    def iter_consensus_histories(self, question_id=None, created_before=None, created_after=None,
+                                 updated_before=None, updated_after=None, batches=False, per_page=None):
+        """
+            Generator version of get_consensus_histories.  Takes the same optional inputs, but
+            yields consensus records as each page arrives instead of collecting the whole
+            history in memory first.
+            
+            batches - <boolean> - If true, yield one list of consensus records per page
+                                  rather than individual records
+                Default: False
+        """
+        
+        url = self.consensus_histories_url
+        section = 'consensus_histories'
+        params = self._consensus_histories_params(question_id, created_before, created_after,
+                                                  updated_before, updated_after, per_page)
+        
+        return self._iter_section(url=url,section=section,params=params,batches=batches)
+    
+    def _consensus_histories_params(self, question_id, created_before, created_after,
+                                    updated_before, updated_after, per_page=None):
         if (not created_before) and (not created_after) and (not updated_before) and (not updated_after):
             print("After your first query, use a date constraint (created_before/after or",\
                   "updated_before/after) to get consensus history. Old values won't change")
         
-        url = self.consensus_histories_url
-        section = 'consensus_histories'
         params={}
         
         if question_id:
@@ -205,8 +511,10 @@ class GfcApi(object):
             params['updated_before'] = updated_before.isoformat()
         if updated_after:
             params['updated_after'] = updated_after.isoformat()
+        if per_page:
+            params['per_page'] = per_page
         
-        return self._get_pages(url=url,section=section,params=params)   
+        return params
     
     def submit_forecast(self,question_id,method_name,predictions):
         """
@@ -243,14 +551,27 @@ class GfcApi(object):
         """
     
         url = self.external_prediction_sets_url
+        params = self._submit_params(question_id,method_name,predictions)
         
+        return self._post(url,params)
+    
+    def submit_forecasts(self,jobs,questions=None,workers=4,retries=2):
+        """
+            Validate and submit many (question_id, method_name, predictions) forecasts at
+            once through a pool of workers sharing this client's rate limit.  Returns a
+            per-job report DataFrame.  See iarpa_submit.submit_forecasts for details.
+        """
+        from iarpa_submit import submit_forecasts
+        return submit_forecasts(self,jobs,questions=questions,workers=workers,retries=retries)
+    
+    def _submit_params(self,question_id,method_name,predictions):
         params={'external_prediction_set':{'question_id':question_id,
                                           'external_predictor_attributes':
                                            {'method_name':method_name},
                                            'external_predictions_attributes':predictions}
                 }
         
-        return self._post(url,params)
+        return params
     
     def _forecast_template(self,ifp):
         """
@@ -278,53 +599,186 @@ class GfcApi(object):
             The 'url' and 'params' describe the API query, the 'section' is the key in the
             returned json that contains the list of query results (e.g., 'questions').
         """
+        all_results = []
+        try:
+            for this_batch in self.iter_pages(url=url,params=params,section=section):
+                all_results.extend(this_batch)
+        except GfcApiError as err:
+            if isinstance(err.results,dict) and 'errors' in err.results:
+                print(err.results['errors'])
+            return err.results
+
+        return all_results                
+    
+    def iter_pages(self,url,params,section,workers=None,start_page=1):
+        """
+            Generator version of _get_pages.  Yields the list of query results from each
+            page as soon as that page has been retrieved, so callers can write or
+            aggregate one page at a time without holding the full result set.
+            
+            workers - <integer> - Overrides self.page_workers for this query.  When more than
+                                  one worker is used, the remaining pages are fetched
+                                  concurrently after page 1 but are still yielded in order.
+            
+            start_page - <integer> - First page to request, for resuming an interrupted pull
+                Default: 1
+            
+            Raises GfcApiError if the API returns an error or a page can't be retrieved
+            within page_retries attempts; the offending json (or None) is available as
+            the exception's 'results'.
+        """
+        params = self._page_params(params)
+        if not self.hooks:
+            for this_batch in self._iter_pages(url,params,section,workers,start_page):
+                yield this_batch
+            return
+        
+        endpoint = self._endpoint(url)
+        started = time.perf_counter()
+        pages = 0
+        records = 0
+        completed = False
+        try:
+            for this_batch in self._iter_pages(url,params,section,workers,start_page):
+                self._emit('page',endpoint=endpoint,page=start_page+pages,records=len(this_batch))
+                pages+=1
+                records+=len(this_batch)
+                yield this_batch
+            completed = True
+        finally:
+            self._emit('query',endpoint=endpoint,pages=pages,records=records,
+                       seconds=time.perf_counter()-started,completed=completed)
+    
+    def _iter_pages(self,url,params,section,workers,start_page):
         if self.verbose:
             print('Get Pages for {}'.format(url))
             print(params)
-        page = 1
-        maxPage = 1
+        if workers is None:
+            workers = self.page_workers
         
-        all_results = []
-        this_batch = []
-        while page <= maxPage: 
+        results, maxPage = self._get_page(url,params,start_page,section)
+        yield results[section]
+        
+        if workers <= 1 or maxPage <= start_page+1:
+            page = start_page+1
+            while page <= maxPage: 
+                results, maxPage = self._get_page(url,params,page,section)
+                yield results[section]
+                page+=1
+            return
+        
+        # Keep a bounded window of pages in flight so a slow consumer doesn't
+        # pile the whole history up in finished futures.
+        window = 2*workers
+        pending = {}
+        next_page = start_page+1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for page in range(start_page+1,maxPage+1):
+                    while next_page <= maxPage and next_page < page+window:
+                        pending[next_page] = pool.submit(self._get_page,url,params,next_page,section)
+                        next_page+=1
+                    results, _ = pending.pop(page).result()
+                    yield results[section]
+            finally:
+                for future in pending.values():
+                    future.cancel()
+    
+    def _page_params(self,params):
+        """
+            The query params with the client's per_page filled in, unless already given.
+        """
+        if self.per_page and 'per_page' not in params:
+            params = dict(params)
+            params['per_page'] = self.per_page
+        return params
+    
+    def _get_page(self,url,params,page,section=None):
+        """
+            Retrieve a single page of a query, retrying it on its own after connection
+            errors, 5xx / 429 responses or bodies that aren't json.  With stream_pages
+            (and a section) a successful body is streamed and only the section's records
+            are decoded.
+            
+            Returns the decoded json and the X-Total-Page-Count reported with it.
+        """
+        params = dict(params) # Each page (and thread) gets its own copy
+        params['page'] = page
+        stream = self.stream_pages and section is not None
+        attempt = 0
+        while True:
+            try:
+                resp = self._get(url=url,params=params,stream=stream)
+            except requests.exceptions.RequestException as err:
+                if attempt >= self.page_retries:
+                    raise GfcApiError(None)
+                if self.verbose:
+                    print("{}: page {} failed ({}), retrying".format(time.ctime(),page,err))
+                attempt+=1
+                continue
             
-            params['page']=page
-            resp = self._get(url=url,params=params)
-            maxPage = int(resp.headers.get('X-Total-Page-Count',0))
+            decode_started = time.perf_counter()
             try:
-                results=resp.json()
+                if stream and resp.status_code == 200:
+                    results={section:list(iarpa_json.iter_response(resp,section))}
+                else:
+                    results=iarpa_json.loads(resp.content)
             except:
                 results=None
+                if stream:
+                    resp.close() # give back a connection left mid-body
+            if self.hooks:
+                self._emit('decode',endpoint=self._endpoint(url),
+                           seconds=time.perf_counter()-decode_started)
             if isinstance(results,(list,dict)):
-                if 'errors' in results:
-                    print(results['errors'])
-                    return results
-                
-                this_batch = results[section]
-                all_results.extend(this_batch)
-
-                page+=1
-            else:
+                if 'errors' in results and resp.status_code < 500 and resp.status_code != 429:
+                    raise GfcApiError(results)
+                if 'errors' not in results:
+                    return results, int(resp.headers.get('X-Total-Page-Count',0))
+            
+            if attempt >= self.page_retries:
                 if self.verbose:
                     print("PROBLEM")
-                return results
-
-        return all_results                
+                raise GfcApiError(results)
+            if self.verbose:
+                print("{}: page {} returned status {}, retrying".format(time.ctime(),page,
+                                                                         resp.status_code))
+            attempt+=1
+    
+    def _iter_section(self,url,params,section,batches=False):
+        """
+            Wraps iter_pages to yield either page-sized batches or individual records.
+        """
+        pages = self.iter_pages(url=url,params=params,section=section)
+        if batches:
+            return pages
+        return (record for this_batch in pages for record in this_batch)
         
-    def _get(self,url,params):
+    def _get(self,url,params,stream=False):
         """
-            A helper function that handles authentication and rate limiting.
+            A helper function that handles authentication, rate limiting and caching.
             
             Given a URL and a set of parameters, this function calls the Cultivate API
             and returns the json response.
         """
         
-        while time.time() < self.last_call_time + self.rate_limit_delay:
-            if self.verbose:
-                print("{}: Sleeping".format(time.ctime()))
-            time.sleep(1)
+        cached = None
+        if self.cache is not None:
+            cached, fresh = self.cache.lookup(url,params)
+            if fresh:
+                if self.verbose:
+                    print("{}: CACHED {}".format(time.ctime(),url))
+                if self.hooks:
+                    self._emit('cache_hit',endpoint=self._endpoint(url))
+                return cached
         
         headers={'Authorization':'Bearer ' + self.token} #This is needed to authenticate
+        if cached is not None:
+            # Ask the server whether our stale copy is still good
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
 
         if self.verbose:
             print("{}: GETTING {}".format(time.ctime(),url))
@@ -332,9 +786,15 @@ class GfcApi(object):
             safeHeaders['Authorization']="Bearer <shhhhhh it's a secret>"
             print("\tHeaders: {}".format(safeHeaders))
             print("\tArgs: {}".format(params))
-        resp = self.sess.get(url, headers=headers, params=params, proxies=self.proxy)
+        resp = self._send(self.sess.get, url, headers=headers, params=params, proxies=self.proxy,
+                          stream=stream)
+        
+        if self.cache is not None:
+            if resp.status_code == 304 and cached is not None:
+                self.cache.refresh(url,params)
+                return cached
+            self.cache.store(url,params,resp)
                                                                                          
-        self.last_call_time = time.time()
         return resp
     
     def _post(self,url,params):
@@ -349,11 +809,6 @@ class GfcApi(object):
 
         """
 
-        while time.time() < self.last_call_time + self.rate_limit_delay:
-            if self.verbose:
-                print("{}: Sleeping".format(time.ctime()))
-            time.sleep(1)
-        
         headers={'Authorization':'Bearer ' + self.token} #This is needed to authenticate
 
         if self.verbose:
@@ -362,9 +817,76 @@ class GfcApi(object):
             safeHeaders['Authorization']="Bearer <shhhhhh it's a secret>"
             print("\tHeaders: {}".format(safeHeaders))
             print("\tArgs: {}".format(params))
-        resp = self.sess.post(url, headers=headers, json=params, proxies=self.proxy) 
+        resp = self._send(self.sess.post, url, headers=headers, json=params, proxies=self.proxy)
                                                                                          
-        self.last_call_time = time.time()
-        
         return resp.json()
     
+    def _send(self,send,url,**kwargs):
+        """
+            Make a single request through the shared rate limiter.  429 responses are
+            reported to the limiter (honouring Retry-After) and retried up to
+            max_throttle_retries times.
+        """
+        attempt = 0
+        waited = 0.0
+        while True:
+            wait = self.rate_limiter.acquire()
+            waited += wait
+            if wait and self.verbose:
+                print("{}: Slept {:.2f}s for rate limit".format(time.ctime(),wait))
+            sent = time.perf_counter()
+            resp = send(url, **kwargs)
+            if self.hooks:
+                self._emit('request',endpoint=self._endpoint(url),method=send.__name__.upper(),
+                           status=resp.status_code,seconds=time.perf_counter()-sent,
+                           bytes=_body_size(resp,kwargs.get('stream')),wait=waited,
+                           throttled=resp.status_code == 429)
+                waited = 0.0
+            if resp.status_code != 429 or attempt >= self.max_throttle_retries:
+                break
+            resp.close()
+            retry_after = _retry_after_seconds(resp.headers.get('Retry-After'))
+            if self.verbose:
+                print("{}: Throttled, backing off {}".format(time.ctime(),retry_after))
+            self.rate_limiter.backoff(retry_after)
+            attempt+=1
+        
+        if resp.status_code != 429:
+            self.rate_limiter.success()
+        return resp
+    
+    def _emit(self,event,**fields):
+        for hook in self.hooks:
+            hook(event,fields)
+    
+    def _endpoint(self,url):
+        """
+            The part of a URL after the server, used to label metrics.
+        """
+        if url.startswith(self.server):
+            return url[len(self.server):]
+        return url
+
+def _body_size(resp,stream):
+    """
+        Bytes in a response body, without reading a streamed one: for those, the
+        Content-Length the server sent (0 if it didn't).
+    """
+    if stream and not getattr(resp,'from_cache',False):
+        return int(resp.headers.get('Content-Length') or 0)
+    return len(resp.content)
+
+def _retry_after_seconds(value):
+    """
+        Parse a Retry-After header, which is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError,ValueError):
+        return None
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Point-in-time (as-of) indexes over consensus histories and human forecasts
+@author: tiffany
+"""
+import numpy
+import pandas
+
+from iarpa_tables import flatten_prediction_sets, _to_epoch_ns
+
+def to_epoch_ns(t):
+    """
+        Convert a datetime / Timestamp / ISO string (or an array of them) to int64
+        nanoseconds since the epoch, UTC.  Naive times are taken to be UTC.
+    """
+    ns = _to_epoch_ns(list(numpy.atleast_1d(t)))
+    if numpy.ndim(t) == 0 and not isinstance(t,(list,tuple)):
+        return ns[0]
+    return ns
+
+def _as_ns(times):
+    times = numpy.asarray(times)
+    if times.dtype == numpy.int64:
+        return times
+    return numpy.atleast_1d(to_epoch_ns(list(times.ravel()))).reshape(times.shape)
+
+class ConsensusIndex(object):
+    """
+        Time-sorted consensus values per question and answer.
+
+        as_of(question_id, t) returns the consensus that had been published at t: for
+        each answer the normalized_value with the latest consensus_at <= t (NaN if
+        there was none yet), found by binary search rather than a filter and sort.
+    """
+    def __init__(self,records=None,value_column='normalized_value'):
+        """
+            records - <list> or <DataFrame> - Consensus history records to start with
+
+            value_column - <string> - Which consensus value to index
+                Default: 'normalized_value'
+        """
+        self.value_column = value_column
+        # question_id -> {answer_id: (times, values)}
+        self._series = {}
+        # question_id -> (answer_ids, times, values) batches not yet in the index
+        self._pending = {}
+        if records is not None:
+            self.update(records)
+
+    def update(self,records):
+        """
+            Add consensus history records (a list from the API, a page from
+            iter_consensus_histories(batches=True), or a DataFrame).  The records are
+            only appended to their questions' buffers here, so an update costs the size
+            of the batch; each question is re-sorted once, the next time it is queried.
+            A later record for the same question, answer and consensus_at replaces the
+            earlier one.
+        """
+        if isinstance(records,pandas.DataFrame):
+            columns = {c:records[c].tolist() for c in ('question_id','answer_id','consensus_at',self.value_column)}
+        else:
+            records = list(records)
+            columns = {c:[r[c] for r in records] for c in ('question_id','answer_id','consensus_at',self.value_column)}
+        if not columns['question_id']:
+            return
+        times = to_epoch_ns(columns['consensus_at'])
+        values = numpy.asarray(columns[self.value_column],dtype=numpy.float64)
+        answer_ids = numpy.asarray(columns['answer_id'],dtype=numpy.int64)
+        question_ids = numpy.asarray(columns['question_id'],dtype=numpy.int64)
+        order = numpy.argsort(question_ids,kind='stable')
+        starts = numpy.flatnonzero(numpy.append(True,numpy.diff(question_ids[order]) != 0))
+        for rows in numpy.split(order,starts[1:]):
+            self._pending.setdefault(int(question_ids[rows[0]]),[]).append(
+                (answer_ids[rows],times[rows],values[rows]))
+
+    def question_ids(self):
+        return sorted(set(self._series) | set(self._pending))
+
+    def answer_ids(self,question_id):
+        return sorted(self._question(question_id))
+
+    def _question(self,question_id):
+        """
+            A question's {answer_id: (times, values)}, folding in any records added
+            since it was last built.
+        """
+        pending = self._pending.pop(question_id,None)
+        if pending is not None:
+            built = [(numpy.full(len(t),answer_id,dtype=numpy.int64),t,v)
+                     for answer_id, (t, v) in self._series.get(question_id,{}).items()]
+            answer_ids, times, values = (numpy.concatenate(c) for c in zip(*(built + pending)))
+            order = numpy.lexsort((numpy.arange(len(times)),times,answer_ids)) # later records stay later
+            answer_ids, times, values = answer_ids[order], times[order], values[order]
+            # keep the last of any duplicated timestamps
+            keep = numpy.append((answer_ids[1:] != answer_ids[:-1]) | (times[1:] != times[:-1]),True)
+            answer_ids, times, values = answer_ids[keep], times[keep], values[keep]
+            starts = numpy.flatnonzero(numpy.append(True,answer_ids[1:] != answer_ids[:-1]))
+            ends = numpy.append(starts[1:],len(answer_ids))
+            self._series[question_id] = {int(answer_ids[a]):(times[a:b],values[a:b])
+                                         for a, b in zip(starts,ends)}
+        return self._series.get(question_id,{})
+
+    def as_of(self,question_id,t):
+        """
+            The consensus for a question at time t, as a dictionary of answer_id to value.
+        """
+        values = self.as_of_many(question_id,[t])
+        return dict(zip(self.answer_ids(question_id),values[0]))
+
+    def as_of_many(self,question_id,times):
+        """
+            The consensus for a question at many times at once.
+
+            times - <array> - datetimes, or int64 nanoseconds since the epoch
+
+             Output:
+            A (len(times), n_answers) array, with columns in answer_ids(question_id)
+            order and NaN where no consensus had been published yet
+        """
+        times = _as_ns(times)
+        answers = self._question(question_id)
+        out = numpy.full((len(times),len(answers)),numpy.nan)
+        for j, answer_id in enumerate(sorted(answers)):
+            t, v = answers[answer_id]
+            pos = numpy.searchsorted(t,times,side='right') - 1
+            found = pos >= 0
+            out[found,j] = v[pos[found]]
+        return out
+
+ROW_COLUMNS = ['prediction_set_id','question_id','guid_code','answer_id','forecasted_probability',
+               'created_at']
+
+class ForecastIndex(object):
+    """
+        Every forecaster's prediction sets per question, indexed so that "each
+        forecaster's latest forecast as of t" is a binary search per forecaster instead
+        of a scan of the question's history.
+
+        Within a question, prediction sets are sorted by (forecaster, created_at) and
+        given a combined integer key (forecaster code, dense time rank), so one
+        numpy.searchsorted call finds the latest set at or before t for every
+        forecaster at once.
+    """
+    def __init__(self,prediction_sets=None):
+        """
+            prediction_sets - <list> or <DataFrame> - Prediction sets to start with, or a
+                                                      table from flatten_prediction_sets
+        """
+        self._guids = pandas.Index([])
+        self._questions = {} # question_id -> built index
+        self._pending = {}   # question_id -> row batches not yet in the index
+        if prediction_sets is not None:
+            self.update(prediction_sets)
+
+    @property
+    def guids(self):
+        """
+            Every membership_guid seen so far, in the order they were first seen.
+        """
+        return self._guids
+
+    def update(self,prediction_sets):
+        """
+            Add prediction sets (API records, a page, or a flattened table).  The rows
+            are only appended to their questions' buffers here, so an update costs the
+            size of the batch; each question is rebuilt once, the next time it is
+            queried.  A prediction set id seen again replaces its earlier version.
+        """
+        flat = prediction_sets
+        if not (isinstance(flat,pandas.DataFrame) and 'answer_id' in flat):
+            flat = flatten_prediction_sets(prediction_sets)
+        if flat.empty:
+            return
+
+        new_guids = pandas.Index(flat['membership_guid'].astype(str).unique())
+        self._guids = self._guids.append(new_guids.difference(self._guids))
+        flat = flat.assign(guid_code=self._guids.get_indexer(flat['membership_guid'].astype(str)))
+        flat = flat[ROW_COLUMNS]
+
+        for question_id, rows in flat.groupby('question_id',sort=False):
+            self._pending.setdefault(int(question_id),[]).append(rows)
+
+    def question_ids(self):
+        return sorted(set(self._questions) | set(self._pending))
+
+    def _question(self,question_id):
+        """
+            The built index for a question, folding in any rows added since it was
+            last built.
+        """
+        pending = self._pending.pop(question_id,None)
+        if pending is not None:
+            built = self._questions.get(question_id)
+            if built is not None:
+                pending.insert(0,built['rows'])
+            rows = pending[0] if len(pending) == 1 else pandas.concat(pending,ignore_index=True)
+            self._questions[question_id] = self._build(rows)
+        return self._questions.get(question_id)
+
+    def _build(self,rows):
+        rows = rows.drop_duplicates(subset=['prediction_set_id','answer_id'],keep='last')
+        set_col = rows['prediction_set_id'].to_numpy(dtype=numpy.int64)
+        answer_col = rows['answer_id'].to_numpy()
+
+        # One row per prediction set (its latest version), one column per answer
+        set_ids, set_pos = numpy.unique(set_col,return_inverse=True)
+        answer_ids, answer_pos = numpy.unique(answer_col,return_inverse=True)
+        probs = numpy.full((len(set_ids),len(answer_ids)),numpy.nan)
+        probs[set_pos,answer_pos] = rows['forecasted_probability'].to_numpy(dtype=numpy.float64)
+        last = numpy.empty(len(set_ids),dtype=numpy.int64)
+        last[set_pos] = numpy.arange(len(rows))
+        guid_codes = rows['guid_code'].to_numpy(dtype=numpy.int64)[last]
+        times = rows['created_at'].to_numpy(dtype=numpy.int64)[last]
+
+        order = numpy.lexsort((times,guid_codes))
+        set_ids, guid_codes, times, probs = set_ids[order], guid_codes[order], times[order], probs[order]
+
+        unique_times = numpy.unique(times)
+        rank = numpy.searchsorted(unique_times,times,side='right')
+        width = len(unique_times)+1
+        return {'rows':rows,
+                'set_ids':set_ids,
+                'guid_codes':guid_codes,
+                'guids':numpy.unique(guid_codes),
+                'times':unique_times,
+                'width':width,
+                'keys':guid_codes*width + rank,
+                'answer_ids':answer_ids,
+                'probs':probs}
+
+    def as_of(self,question_id,t):
+        """
+            Each forecaster's latest forecast on a question at time t, as a DataFrame
+            indexed by membership_guid with one column per answer_id.  Forecasters who
+            hadn't forecast by t are left out.
+        """
+        guids, answer_ids, probs = self.as_of_many(question_id,[t])
+        df = pandas.DataFrame(probs[0],index=pandas.Index(guids,name='membership_guid'),
+                              columns=answer_ids)
+        return df[~numpy.isnan(probs[0]).all(axis=1)]
+
+    def as_of_many(self,question_id,times):
+        """
+            Every forecaster's latest forecast at many times at once.
+
+             Output:
+            guids - membership_guids that have forecast on the question
+            answer_ids - answer ids, in column order
+            probs - (len(times), len(guids), len(answer_ids)) array, NaN where a
+                    forecaster hadn't forecast yet
+        """
+        q = self._question(question_id)
+        if q is None:
+            return numpy.array([],dtype=object), numpy.array([],dtype=numpy.int32), \
+                   numpy.zeros((len(times),0,0))
+        times = _as_ns(times)
+        rank = numpy.searchsorted(q['times'],times,side='right')
+        query = q['guids'][None,:]*q['width'] + rank[:,None]
+        pos = numpy.searchsorted(q['keys'],query,side='right') - 1
+        found = (pos >= 0) & (q['guid_codes'][numpy.maximum(pos,0)] == q['guids'][None,:])
+
+        probs = numpy.full(found.shape+(len(q['answer_ids']),),numpy.nan)
+        probs[found] = q['probs'][pos[found]]
+        return self._guids[q['guids']].to_numpy(), q['answer_ids'], probs
+
+    def latest_set_ids(self,question_id,t):
+        """
+            Prediction set ids of each forecaster's latest forecast at time t.
+        """
+        q = self._question(question_id)
+        if q is None:
+            return numpy.array([],dtype=numpy.int64)
+        rank = numpy.searchsorted(q['times'],_as_ns([t]),side='right')[0]
+        pos = numpy.searchsorted(q['keys'],q['guids']*q['width'] + rank,side='right') - 1
+        found = (pos >= 0) & (q['guid_codes'][numpy.maximum(pos,0)] == q['guids'])
+        return q['set_ids'][pos[found]]
+
+    def history(self,question_id,guid):
+        """
+            One forecaster's prediction sets on a question in time order: a DataFrame
+            with prediction_set_id and created_at (int64 ns) plus one column per answer_id.
+        """
+        q = self._question(question_id)
+        code = self._guids.get_indexer([guid])[0]
+        if q is None or code < 0:
+            return pandas.DataFrame(columns=['prediction_set_id','created_at'])
+        lo, hi = numpy.searchsorted(q['guid_codes'],[code,code+1])
+        df = pandas.DataFrame(q['probs'][lo:hi],columns=q['answer_ids'])
+        df.insert(0,'prediction_set_id',q['set_ids'][lo:hi])
+        df.insert(1,'created_at',q['times'][q['keys'][lo:hi] % q['width'] - 1])
+        return df
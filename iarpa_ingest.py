@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel ingestion of raw API pages and JSON dumps into compact tables
+@author: tiffany
+"""
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import pandas
+
+import iarpa_json
+from iarpa_tables import FLAT_PREDICTION_COLUMNS, concat_flat, flatten_prediction_sets, _to_epoch_ns
+
+CONSENSUS_COLUMNS = ['id','question_id','answer_id','consensus_at','normalized_value',
+                     'created_at','updated_at']
+
+CHUNK_RECORDS = 50000       # records parsed and normalized at a time
+SPLIT_BYTES = 64 * 2**20    # dump files bigger than this are split across tasks
+SCAN_BYTES = 4 * 2**20      # bytes scanned at a time when looking for split points
+
+def ingest(sources,section,workers=None,split_bytes=SPLIT_BYTES):
+    """
+        Parse and normalize many raw pages or dump files at once in a process pool, and
+        merge the results.
+
+        sources - <list> - Each one is a path to a JSON file or the raw bytes of a
+                           response body.  A source can be an API page ({"prediction_sets":
+                           [...], ...}) or a bare array (a json.dump of get_human_forecasts()).
+                           Files are streamed and normalized CHUNK_RECORDS records at a
+                           time, so only the compact tables are ever held whole.
+
+        section - <string> - 'prediction_sets' or 'consensus_histories'
+
+        workers - <integer> - Number of processes.  None uses every core, 1 runs in this
+                              process.
+            Default: None
+
+        split_bytes - <integer> - A bare-array file bigger than this is cut, at record
+                                  boundaries, into pieces of about this size that are
+                                  parsed as separate tasks, so one big dump still uses
+                                  every worker
+            Default: 64 MB
+
+         Output:
+        prediction_sets - the long table from iarpa_tables.flatten_prediction_sets
+        consensus_histories - one row per record with CONSENSUS_COLUMNS; timestamps are
+                              int64 nanoseconds since the epoch (UTC)
+
+        A record id seen in more than one source is kept once: the copy with the latest
+        updated_at, or the one from the later source on a tie.  Rows come out sorted by
+        id, so the result depends only on the sources and their order, not on workers.
+    """
+    if section not in NORMALIZERS:
+        raise ValueError("Can't ingest {}; expected one of {}".format(section,sorted(NORMALIZERS)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    jobs = []
+    for source in sources:
+        ranges = [None]
+        if workers > 1 and not isinstance(source,(bytes,bytearray)) and os.path.getsize(source) > split_bytes:
+            ranges = split_array(source,split_bytes)
+        jobs.extend((source,section,byte_range) for byte_range in ranges)
+    if workers <= 1 or len(jobs) <= 1:
+        results = [_ingest_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_ingest_job,jobs))
+    # Chunks stay in source (and file) order, which settles ties at merge time
+    return MERGERS[section]([frame for frames in results for frame in frames])
+
+def read_records(source,section,byte_range=None):
+    """
+        Stream the records of one source (a path or raw bytes), whether it is an API
+        page keyed by 'section' or a bare array.  'byte_range' is a (start, end) piece
+        of a bare-array file from split_array.
+    """
+    if byte_range is not None:
+        return iarpa_json.iter_array(_read_range(source,*byte_range))
+    if isinstance(source,(bytes,bytearray)):
+        chunks = [bytes(source)]
+        key = section if bytes(source).lstrip()[:1] == b'{' else None
+        return iarpa_json.iter_array(chunks,key)
+    with open(source,'rb') as infile:
+        first = infile.read(64).lstrip()[:1]
+    return iarpa_json.iter_file(source,section if first == b'{' else None)
+
+# Bytes that can change the scanner's state in split_array
+_SPECIAL = numpy.zeros(256,dtype=bool)
+_SPECIAL[[ord(c) for c in '"\\[]{}']] = True
+
+def split_array(path,split_bytes=SPLIT_BYTES):
+    """
+        Cut a file holding one bare JSON array into (start, end) byte ranges of about
+        split_bytes each, every one starting at a record.  A file that isn't a bare
+        array is returned as a single None range (read it whole).
+
+        The split points come from a vectorised pass over the file, SCAN_BYTES at a
+        time, that tracks which bytes are inside strings and the bracket depth, so it
+        costs a fraction of actually parsing the records.
+    """
+    size = os.path.getsize(path)
+    with open(path,'rb') as infile:
+        if infile.read(64).lstrip()[:1] != b'[':
+            return [None]
+    targets = list(range(split_bytes,size,split_bytes))
+    starts = [0]
+    escaped = False # the last byte of the previous block was an unescaped backslash
+    in_string = False
+    depth = 0
+    offset = 0
+    with open(path,'rb') as infile:
+        while targets:
+            block = numpy.frombuffer(infile.read(SCAN_BYTES),dtype=numpy.uint8)
+            if not len(block):
+                break
+            # Only quotes, backslashes and brackets matter; work on those bytes alone
+            pos = numpy.flatnonzero(_SPECIAL[block])
+            chars = block[pos]
+            quotes = chars == ord('"')
+            slashes = numpy.flatnonzero(block == ord('\\'))
+            if escaped or len(slashes):
+                # A run of backslashes of odd length escapes the byte after it
+                firsts = lasts = numpy.zeros(0,dtype=numpy.int64)
+                if len(slashes):
+                    breaks = numpy.flatnonzero(numpy.diff(slashes) != 1) + 1
+                    firsts = numpy.concatenate([[0],breaks])
+                    lasts = numpy.concatenate([breaks - 1,[len(slashes) - 1]])
+                lengths = lasts - firsts + 1
+                skipped = []
+                if escaped:
+                    if len(slashes) and slashes[0] == 0:
+                        lengths[0] += 1 # the run carries on from the previous block
+                    else:
+                        skipped = [0]
+                ends = slashes[lasts]
+                skipped = numpy.concatenate([skipped,ends[lengths % 2 == 1] + 1])
+                quotes &= ~numpy.isin(pos,skipped)
+                escaped = bool(len(ends) and ends[-1] == len(block) - 1 and lengths[-1] % 2 == 1)
+            toggles = numpy.cumsum(quotes)
+            inside = ((toggles - quotes) % 2 == 1) ^ in_string               # in a string before this byte
+            opens = ((chars == ord('{')) | (chars == ord('['))) & ~inside
+            closes = ((chars == ord('}')) | (chars == ord(']'))) & ~inside
+            after = depth + numpy.cumsum(opens.astype(numpy.int64) - closes)
+            records = pos[opens & (after == 2)] + offset                     # records open at depth 1
+
+            # The first record at or after each target offset starts a piece
+            while targets and len(records) and records[-1] >= targets[0]:
+                start = int(records[numpy.searchsorted(records,targets[0])])
+                starts.append(start)
+                targets = [t for t in targets if t > start]
+
+            if len(pos):
+                in_string = bool((toggles[-1] % 2 == 1) ^ in_string)
+                depth = int(after[-1])
+            offset += len(block)
+    return [(start,end) for start, end in zip(starts,starts[1:] + [size])]
+
+def normalize_prediction_sets(records):
+    """
+        Flatten prediction sets, keeping only the newest copy of each id, and add the
+        set's updated_at (int64 ns) to every row so shards can be merged.
+    """
+    latest = _latest_by_id(records)
+    flat = flatten_prediction_sets(latest)
+    counts = numpy.asarray([len(ps['predictions']) for ps in latest],dtype=numpy.int64)
+    flat['updated_at'] = numpy.repeat(_updated_ns(latest),counts)
+    return flat
+
+def normalize_consensus_histories(records):
+    latest = _latest_by_id(records)
+    df = pandas.DataFrame({
+        'id':numpy.asarray([r['id'] for r in latest],dtype=numpy.int64),
+        'question_id':numpy.asarray([r['question_id'] for r in latest],dtype=numpy.int32),
+        'answer_id':numpy.asarray([r['answer_id'] for r in latest],dtype=numpy.int32),
+        'consensus_at':_to_epoch_ns([r['consensus_at'] for r in latest]),
+        'normalized_value':numpy.asarray([r.get('normalized_value') for r in latest],dtype=numpy.float64),
+        'created_at':_to_epoch_ns([r['created_at'] for r in latest]),
+        'updated_at':_updated_ns(latest)},
+        columns=CONSENSUS_COLUMNS)
+    return df
+
+def merge_prediction_sets(frames):
+    """
+        Combine flattened shards, keeping each prediction set from exactly one shard.
+    """
+    for shard, frame in enumerate(frames):
+        frame['shard'] = numpy.full(len(frame),shard,dtype=numpy.int32)
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return normalize_prediction_sets([])
+    df = concat_flat(frames)
+
+    sets = df[['prediction_set_id','updated_at','shard']].drop_duplicates()
+    winners = sets.sort_values(['prediction_set_id','updated_at','shard'],kind='stable') \
+                  .drop_duplicates('prediction_set_id',keep='last')
+    df = df.merge(winners,on=['prediction_set_id','updated_at','shard'],how='inner',sort=False)
+    df = df.sort_values(['prediction_set_id','answer_id'],kind='stable').reset_index(drop=True)
+    return df[FLAT_PREDICTION_COLUMNS + ['updated_at']]
+
+def merge_consensus_histories(frames):
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return normalize_consensus_histories([])
+    df = pandas.concat(frames,ignore_index=True)
+    df = df.sort_values('updated_at',kind='stable').drop_duplicates('id',keep='last')
+    return df.sort_values('id').reset_index(drop=True)
+
+NORMALIZERS = {'prediction_sets':normalize_prediction_sets,
+               'consensus_histories':normalize_consensus_histories}
+
+MERGERS = {'prediction_sets':merge_prediction_sets,
+           'consensus_histories':merge_consensus_histories}
+
+def _ingest_job(job):
+    """
+        Normalize one source (or piece of one) CHUNK_RECORDS records at a time.
+    """
+    source, section, byte_range = job
+    records = read_records(source,section,byte_range)
+    frames = []
+    while True:
+        chunk = list(itertools.islice(records,CHUNK_RECORDS))
+        if not chunk and frames:
+            return frames
+        frames.append(NORMALIZERS[section](chunk))
+        if len(chunk) < CHUNK_RECORDS:
+            return frames
+
+def _read_range(path,start,end,chunk_size=iarpa_json.CHUNK_SIZE):
+    """
+        The bytes [start, end) of a bare-array file, as a stream that is itself one
+        array: the records there, bracketed.  The first piece already has the file's
+        opening bracket, and the last its closing one (a spare ']' is never read).
+    """
+    if start > 0:
+        yield b'['
+    with open(path,'rb') as infile:
+        infile.seek(start)
+        left = end - start
+        while left > 0:
+            chunk = infile.read(min(chunk_size,left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+    yield b']'
+
+def _latest_by_id(records):
+    """
+        The records with duplicate ids dropped, keeping the latest updated_at (the later
+        record on a tie), in order of first appearance.
+    """
+    latest = {}
+    for record in records:
+        old = latest.get(record['id'])
+        if old is None or _updated(record) >= _updated(old):
+            latest[record['id']] = record
+    return list(latest.values())
+
+def _updated(record):
+    return pandas.Timestamp(record.get('updated_at') or record['created_at'])
+
+def _updated_ns(records):
+    return _to_epoch_ns([r.get('updated_at') or r['created_at'] for r in records])
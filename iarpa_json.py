@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON decoding for API pages and local dumps: a pluggable fast decoder, and a streaming
+parser that yields the records of one array without loading the whole document
+@author: tiffany
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CHUNK_SIZE = 1 << 20 # bytes read at a time from files and HTTP bodies
+
+_decoder = orjson.loads if orjson is not None else json.loads
+
+def set_decoder(loads):
+    """
+        Use 'loads' (any function taking bytes or str and returning Python objects, e.g.
+        orjson.loads or ujson.loads) for every page and record decoded from now on.
+        Pass None to go back to the default: orjson if it is installed, else json.
+    """
+    global _decoder
+    if loads is None:
+        loads = orjson.loads if orjson is not None else json.loads
+    _decoder = loads
+
+def get_decoder():
+    return _decoder
+
+def loads(data):
+    """
+        Decode a complete JSON document with the current decoder.
+    """
+    return _decoder(data)
+
+# The only bytes that change the parser's state: quotes, backslashes and brackets
+_SPECIAL = re.compile(rb'[\\"\[\]{}]')
+
+def iter_array(chunks,section=None):
+    """
+        Yield the elements of one JSON array, one at a time, from a stream of bytes.
+
+        chunks - <iterable> - bytes objects in document order (a file read in pieces,
+                              or an HTTP body from iter_content)
+
+        section - <string> - The key of the array inside the top-level object, e.g.
+                             'prediction_sets' for an API page.  None means the document
+                             itself is the array, as in a json.dump of get_human_forecasts().
+            Default: None
+
+        Each element's bytes are cut out and decoded on their own, so memory and decode
+        work per step scale with one record, not with the document.  Elements must be
+        objects or arrays, which every API record is.
+
+        Raises ValueError if the stream ends before the array does, or never reaches
+        it (e.g. an error response with no 'section'), so a cut-off body can't pass for
+        a short one.
+    """
+    target_key = section.encode('utf-8') if section is not None else None
+    buf = b''
+    pos = 0             # next byte of buf to scan
+    depth = 0
+    in_string = False
+    string_start = None # where the current string started (for reading keys)
+    last_key = None     # most recent string seen at depth 1
+    target = None       # depth of the array's elements, once the array is found
+    element_start = None
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf += chunk
+        while True:
+            match = _SPECIAL.search(buf,pos)
+            if match is None:
+                pos = len(buf)
+                break
+            i = match.start()
+            c = buf[i:i+1]
+            if in_string:
+                if c == b'\\':
+                    if i + 1 >= len(buf):
+                        # the escaped byte is in the next chunk
+                        pos = i
+                        break
+                    pos = i + 2
+                    continue
+                if c == b'"':
+                    in_string = False
+                    if target is None and depth == 1:
+                        last_key = buf[string_start+1:i]
+                pos = i + 1
+                continue
+
+            if c == b'"':
+                in_string = True
+                string_start = i
+            elif c == b'{' or c == b'[':
+                if target is None:
+                    if target_key is None and depth == 0 and c == b'[':
+                        target = 1
+                    elif target_key is not None and depth == 1 and c == b'[' and last_key == target_key:
+                        target = 2
+                elif depth == target:
+                    element_start = i
+                depth += 1
+            else:
+                depth -= 1
+                if target is not None:
+                    if depth == target and element_start is not None:
+                        yield _decoder(buf[element_start:i+1])
+                        element_start = None
+                    elif depth < target:
+                        return
+            pos = i + 1
+
+        # Drop everything we no longer need before reading more
+        keep = pos
+        if element_start is not None:
+            keep = min(keep,element_start)
+        if in_string:
+            keep = min(keep,string_start)
+        if keep:
+            buf = buf[keep:]
+            pos -= keep
+            if element_start is not None:
+                element_start -= keep
+            if string_start is not None:
+                string_start -= keep
+
+    if target is None:
+        raise ValueError("No {} array in the document".format(
+            "'{}'".format(section) if section is not None else 'top-level'))
+    raise ValueError("The document ended inside the array")
+
+def iter_file(path,section=None,chunk_size=CHUNK_SIZE):
+    """
+        Stream the records of a JSON dump on disk (see iter_array).
+    """
+    with open(path,'rb') as infile:
+        for record in iter_array(iter(lambda: infile.read(chunk_size),b''),section):
+            yield record
+
+def iter_response(resp,section,chunk_size=CHUNK_SIZE):
+    """
+        Stream the records of an HTTP response (see iter_array).  Request it with
+        stream=True so requests doesn't read the body up front (GfcApi does this for
+        pages when created with stream_pages=True).
+    """
+    return iter_array(resp.iter_content(chunk_size=chunk_size),section)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Request-level metrics for GfcApi
+@author: tiffany
+"""
+import json
+import threading
+
+# Events GfcApi hands to its hooks, and the fields each one carries:
+#   request - endpoint, method, status, seconds, bytes, wait, throttled
+#   cache_hit - endpoint
+#   decode - endpoint, seconds
+#   page - endpoint, page, records
+#   query - endpoint, pages, records, seconds, completed
+
+LATENCY_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+BYTES_BUCKETS = (1e3,1e4,1e5,2.5e5,5e5,1e6,2.5e6,5e6,1e7)
+COUNT_BUCKETS = (1,5,10,25,50,100,250,500,1000,5000,10000)
+
+# metric name -> (type, help, buckets)
+METRICS = {
+    'gfc_requests_total':('counter','HTTP requests made, by status',None),
+    'gfc_throttled_total':('counter','429 responses that were backed off and retried',None),
+    'gfc_cache_hits_total':('counter','GET requests answered from the response cache',None),
+    'gfc_request_seconds':('histogram','Time from sending a request to its response',LATENCY_BUCKETS),
+    'gfc_response_bytes':('histogram','Size of response bodies',BYTES_BUCKETS),
+    'gfc_rate_limit_wait_seconds':('histogram','Time spent waiting on the rate limiter',LATENCY_BUCKETS),
+    'gfc_decode_seconds':('histogram','Time spent decoding page json',LATENCY_BUCKETS),
+    'gfc_page_records':('histogram','Records per page',COUNT_BUCKETS),
+    'gfc_query_pages':('histogram','Pages per paged query',COUNT_BUCKETS),
+    'gfc_query_seconds':('histogram','Wall time of a paged query',LATENCY_BUCKETS + (60.0,300.0,1800.0)),
+}
+
+class MetricsRegistry(object):
+    """
+        Aggregates GfcApi events into counters and histograms.  Pass one as a hook:
+
+            metrics = MetricsRegistry()
+            gf = GfcApi(token,server,hooks=[metrics])
+            ...
+            print(metrics.to_prometheus())
+
+        Any callable taking (event, fields) can be a hook; this one just keeps the
+        numbers needed to see where sync time goes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def __call__(self,event,fields):
+        endpoint = fields.get('endpoint','')
+        if event == 'request':
+            labels = {'endpoint':endpoint,'method':fields['method']}
+            self.increment('gfc_requests_total',dict(labels,status=str(fields['status'])))
+            self.observe('gfc_request_seconds',fields['seconds'],labels)
+            self.observe('gfc_response_bytes',fields['bytes'],labels)
+            self.observe('gfc_rate_limit_wait_seconds',fields['wait'],labels)
+            if fields.get('throttled'):
+                self.increment('gfc_throttled_total',labels,fields['throttled'])
+        elif event == 'cache_hit':
+            self.increment('gfc_cache_hits_total',{'endpoint':endpoint})
+        elif event == 'decode':
+            self.observe('gfc_decode_seconds',fields['seconds'],{'endpoint':endpoint})
+        elif event == 'page':
+            self.observe('gfc_page_records',fields['records'],{'endpoint':endpoint})
+        elif event == 'query':
+            self.observe('gfc_query_pages',fields['pages'],{'endpoint':endpoint})
+            self.observe('gfc_query_seconds',fields['seconds'],{'endpoint':endpoint})
+
+    def increment(self,name,labels,amount=1):
+        with self._lock:
+            series = self._get_series(name,labels)
+            series['value'] += amount
+
+    def observe(self,name,value,labels):
+        with self._lock:
+            series = self._get_series(name,labels)
+            series['count'] += 1
+            series['sum'] += value
+            series['min'] = value if series['min'] is None else min(series['min'],value)
+            series['max'] = value if series['max'] is None else max(series['max'],value)
+            for i, bound in enumerate(METRICS[name][2]):
+                if value <= bound:
+                    series['buckets'][i] += 1
+
+    def _get_series(self,name,labels):
+        key = (name,tuple(sorted(labels.items())))
+        series = self._series.get(key)
+        if series is None:
+            if METRICS[name][0] == 'counter':
+                series = {'value':0}
+            else:
+                series = {'count':0,'sum':0.0,'min':None,'max':None,
+                          'buckets':[0]*len(METRICS[name][2])}
+            self._series[key] = series
+        return series
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def summary(self):
+        """
+            Every series as a list of dictionaries: name, labels and either 'value'
+            (counters) or count / sum / mean / min / max (histograms).
+        """
+        out = []
+        with self._lock:
+            for (name, labels), series in sorted(self._series.items()):
+                row = {'name':name,'labels':dict(labels)}
+                if 'value' in series:
+                    row['value'] = series['value']
+                else:
+                    row.update({k:series[k] for k in ('count','sum','min','max')})
+                    row['mean'] = series['sum']/series['count'] if series['count'] else None
+                out.append(row)
+        return out
+
+    def to_json(self,**kwargs):
+        return json.dumps(self.summary(),**kwargs)
+
+    def to_prometheus(self):
+        """
+            The registry in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            items = sorted(self._series.items())
+        seen = set()
+        for (name, labels), series in items:
+            kind, help_text, buckets = METRICS[name]
+            if name not in seen:
+                lines.append('# HELP {} {}'.format(name,help_text))
+                lines.append('# TYPE {} {}'.format(name,kind))
+                seen.add(name)
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name,_labels(labels),series['value']))
+                continue
+            # Prometheus buckets are cumulative; ours count each value once per
+            # bucket it fits under, which already is
+            for bound, count in zip(buckets,series['buckets']):
+                lines.append('{}_bucket{} {}'.format(name,_labels(labels + (('le',repr(float(bound))),)),count))
+            lines.append('{}_bucket{} {}'.format(name,_labels(labels + (('le','+Inf'),)),series['count']))
+            lines.append('{}_sum{} {}'.format(name,_labels(labels),series['sum']))
+            lines.append('{}_count{} {}'.format(name,_labels(labels),series['count']))
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k,str(v).replace('\\','\\\\').replace('"','\\"'))
+                          for k, v in labels) + '}'
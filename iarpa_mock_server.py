@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the GF Challenge API, for benchmarks and experiments that must not
+touch the real servers.
+
+Run it on its own with
+    python iarpa_mock_server.py --port 8000 --prediction-sets 100000
+and point GfcApi at http://127.0.0.1:8000 with any token.
+@author: tiffany
+"""
+import argparse
+import bisect
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+EPOCH = datetime.datetime(2018,1,3,tzinfo=datetime.timezone.utc)
+
+def _stamp(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def _parse(value):
+    return datetime.datetime.fromisoformat(value.replace('Z','+00:00')).astimezone(datetime.timezone.utc)
+
+class MockData(object):
+    """
+        Synthetic questions, prediction sets and consensus histories shaped like the
+        API's, generated deterministically from a seed.  Records are kept in
+        created_at order.
+    """
+    def __init__(self,questions=200,forecasters=2000,prediction_sets=50000,
+                 consensus_per_question=60,seed=0):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.clock = 0 # seconds after EPOCH of the newest record
+        self.questions = []
+        self.prediction_sets = []
+        self.consensus_histories = []
+        self.submissions = []
+        self.guids = ['{:032x}'.format(self.rng.getrandbits(128)) for _ in range(forecasters)]
+        self.add_questions(questions)
+        self.add_prediction_sets(prediction_sets)
+        self.add_consensus(consensus_per_question)
+
+    def _tick(self,span=60):
+        self.clock += self.rng.randint(1,span)
+        return self.clock
+
+    def add_questions(self,n):
+        with self.lock:
+            for _ in range(n):
+                qid = len(self.questions) + 1
+                n_answers = self.rng.choice([2,2,3,4,5])
+                created = self._tick(3600)
+                self.questions.append({
+                    'id':qid,
+                    'name':'Synthetic question {}'.format(qid),
+                    'description':'Generated by iarpa_mock_server',
+                    'type':self.rng.choice(['Forecast::Binary','Forecast::OrderedMultipleChoice']),
+                    'state':'active',
+                    'clarifications':[],
+                    'created_at':_stamp(created),
+                    'updated_at':_stamp(created),
+                    'published_at':_stamp(created),
+                    'starts_at':_stamp(created),
+                    'ends_at':_stamp(created + 90*86400),
+                    'answers':[{'id':qid*10 + a,'name':'Answer {}'.format(a),
+                                'probability':round(1.0/n_answers,4)} for a in range(n_answers)]})
+
+    def add_prediction_sets(self,n):
+        with self.lock:
+            for _ in range(n):
+                q = self.rng.choice(self.questions)
+                weights = [self.rng.random() for _ in q['answers']]
+                total = sum(weights)
+                created = _stamp(self._tick(30))
+                self.prediction_sets.append({
+                    'id':len(self.prediction_sets) + 1,
+                    'question_id':q['id'],
+                    'membership_guid':self.rng.choice(self.guids),
+                    'created_at':created,
+                    'updated_at':created,
+                    'predictions':[{'answer_id':a['id'],'forecasted_probability':round(w/total,4)}
+                                   for a, w in zip(q['answers'],weights)]})
+
+    def add_consensus(self,per_question):
+        with self.lock:
+            for _ in range(per_question):
+                for q in self.questions:
+                    weights = [self.rng.random() for _ in q['answers']]
+                    total = sum(weights)
+                    created = _stamp(self._tick(5))
+                    for a, w in zip(q['answers'],weights):
+                        self.consensus_histories.append({
+                            'id':len(self.consensus_histories) + 1,
+                            'question_id':q['id'],
+                            'answer_id':a['id'],
+                            'consensus_at':created,
+                            'normalized_value':round(w/total,4),
+                            'created_at':created,
+                            'updated_at':created})
+
+    def query(self,section,params):
+        records = getattr(self,section)
+        with self.lock:
+            records = list(records)
+        if 'created_after' in params:
+            # records are in created_at order, so skip straight to the window
+            keys = [r['created_at'] for r in records]
+            cutoff = _stamp((_parse(params['created_after']) - EPOCH).total_seconds())
+            records = records[bisect.bisect_right(keys,cutoff):]
+        if 'question_id' in params:
+            qid = int(params['question_id'])
+            key = 'id' if section == 'questions' else 'question_id'
+            records = [r for r in records if r[key] == qid]
+        for name, field, op in (('created_before','created_at',lambda a,b: a < b),
+                                ('updated_after','updated_at',lambda a,b: a > b),
+                                ('updated_before','updated_at',lambda a,b: a < b)):
+            if name in params:
+                bound = _parse(params[name])
+                records = [r for r in records if op(_parse(r[field]),bound)]
+        return records
+
+class MockGfcServer(object):
+    """
+        A threaded HTTP server answering the four endpoints GfcApi uses.
+
+        latency - <float> - Seconds added to every response
+        page_size - <integer> - Records per page (a request's per_page overrides it)
+        error_rate - <float> - Fraction of requests answered with a 500
+        throttle_rate - <float> - Fraction of requests answered with a 429
+        max_rate - <float> - Requests per second before every request gets a 429
+                             (None for no limit)
+        retry_after - <float> - Retry-After sent with a 429
+        compress - <boolean> - gzip bodies for clients that accept it
+    """
+    def __init__(self,data=None,host='127.0.0.1',port=0,latency=0.0,page_size=100,
+                 error_rate=0.0,throttle_rate=0.0,max_rate=None,retry_after=1.0,seed=0,
+                 compress=True):
+        self.data = data or MockData(seed=seed)
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self.compress = compress
+        self.bytes_sent = 0
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self._last_request = 0.0
+        self._lock = threading.Lock()
+        self._cache = {}
+
+        server = self
+        class Handler(_Handler):
+            mock = server
+        self.httpd = ThreadingHTTPServer((host,port),Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host,port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc_info):
+        self.stop()
+
+    def _admit(self):
+        """
+            Returns the status to fail this request with, or None to serve it.
+        """
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            too_fast = self.max_rate is not None and now - self._last_request < 1.0/self.max_rate
+            self._last_request = now
+            roll = self.rng.random()
+        if too_fast or roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def _page(self,section,params):
+        # Data only ever grows, so its size tells us whether a cached result is stale
+        key = (section,len(getattr(self.data,section)),
+               tuple(sorted((k,v) for k,v in params.items() if k not in ('page','per_page'))))
+        with self._lock:
+            records = self._cache.get(key)
+        if records is None:
+            records = self.data.query(section,params)
+            with self._lock:
+                self._cache[key] = records
+        per_page = int(params.get('per_page',self.page_size))
+        page = int(params.get('page',1))
+        pages = (len(records) + per_page - 1) // per_page
+        return records[(page-1)*per_page:page*per_page], pages
+
+ROUTES = {'/api/v1/questions':'questions',
+          '/api/v1/control/prediction_sets':'prediction_sets',
+          '/aggregation/api/v1/control/consensus_histories':'consensus_histories'}
+
+class _Handler(BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, each keep-alive
+    # response stalls ~40ms waiting on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self,*args):
+        pass
+
+    def _reply(self,status,body,headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        if self.mock.compress and 'gzip' in self.headers.get('Accept-Encoding',''):
+            payload = gzip.compress(payload,compresslevel=5)
+            self.send_header('Content-Encoding','gzip')
+        with self.mock._lock:
+            self.mock.bytes_sent += len(payload)
+        self.send_header('Content-Length',str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k,v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _refuse(self):
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        status = self.mock._admit()
+        if status == 429:
+            self._reply(429,{'errors':'Too many requests'},{'Retry-After':str(self.mock.retry_after)})
+        elif status == 500:
+            self._reply(500,{'errors':'Internal server error'})
+        return status is not None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        section = ROUTES.get(url.path)
+        if section is None:
+            return self._reply(404,{'errors':'Not found'})
+        if self._refuse():
+            return
+        params = {k:v[-1] for k,v in parse_qs(url.query).items()}
+        records, pages = self.mock._page(section,params)
+        self._reply(200,{section:records},{'X-Total-Page-Count':str(pages)})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length',0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if urlparse(self.path).path != '/api/v1/external_prediction_sets':
+            return self._reply(404,{'errors':'Not found'})
+        if self._refuse():
+            return
+        eps = body.get('external_prediction_set',{})
+        preds = eps.get('external_predictions_attributes',[])
+        total = sum(p.get('value',0) for p in preds)
+        if len(preds) > 1 and abs(total - 1.0) > 1e-9:
+            return self._reply(422,{'errors':'Predictions must sum to 1.0'})
+        with self.mock.data.lock:
+            self.mock.data.submissions.append(eps)
+            eps = dict(eps,id=len(self.mock.data.submissions))
+        self._reply(201,eps)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--questions',type=int,default=200)
+    parser.add_argument('--forecasters',type=int,default=2000)
+    parser.add_argument('--prediction-sets',type=int,default=50000)
+    parser.add_argument('--consensus-per-question',type=int,default=60)
+    parser.add_argument('--latency',type=float,default=0.0)
+    parser.add_argument('--page-size',type=int,default=100)
+    parser.add_argument('--error-rate',type=float,default=0.0)
+    parser.add_argument('--throttle-rate',type=float,default=0.0)
+    parser.add_argument('--max-rate',type=float,default=None)
+    parser.add_argument('--no-compress',action='store_true')
+    args = parser.parse_args()
+
+    data = MockData(args.questions,args.forecasters,args.prediction_sets,args.consensus_per_question)
+    server = MockGfcServer(data,args.host,args.port,latency=args.latency,page_size=args.page_size,
+                           error_rate=args.error_rate,throttle_rate=args.throttle_rate,
+                           max_rate=args.max_rate,compress=not args.no_compress)
+    print("Serving mock GFC API on {}".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Polls for new and clarified IFPs, fast during the weekly release window, and runs
+the forecast pipeline on them as soon as they appear
+@author: tiffany
+"""
+import datetime
+import threading
+import time
+
+from iarpa_catalog import question_status
+
+try:
+    from zoneinfo import ZoneInfo
+    EASTERN = ZoneInfo('America/New_York')
+except Exception:
+    # No tz database: fall back to EST, which is at worst an hour off in summer
+    EASTERN = datetime.timezone(datetime.timedelta(hours=-5),'EST')
+
+# (weekday, start, end) in Eastern time; Monday is 0.  New questions are generally
+# released on Wednesdays between 12:30 and 2:00 PM.
+RELEASE_WINDOWS = [(2,datetime.time(12,30),datetime.time(14,0))]
+
+class ReleaseScheduler(object):
+    """
+        Keeps a QuestionCatalog current and hands every new or clarified IFP to a
+        forecasting pipeline, then submits what the pipeline returns.
+
+        Each poll is one updated_after query (QuestionCatalog.sync), so it is cheap
+        and still goes through the client's rate limiter.  Inside a release window
+        (plus 'lead' before it) the catalog is polled every 'fast_interval' seconds;
+        outside, every 'slow_interval' seconds, but never sleeping past the start of
+        the next window.
+
+        Only active IFPs go to the pipeline (the first sync of an empty catalog reports
+        every IFP ever published as new).  An IFP stays pending until every forecast
+        the pipeline made for it has been submitted: if the pipeline raises or a
+        submission fails, it is offered to the pipeline again on a later poll, backing
+        off per IFP, up to 'max_attempts' times.  Failed forecasts never slow down the
+        question polling; only failed polls do.
+
+            def pipeline(ifps,catalog):
+                return [(ifp['id'],'my_method',predictions) for ifp in ifps]
+
+            ReleaseScheduler(gf,QuestionCatalog(path),pipeline).run()
+    """
+    def __init__(self,gf,catalog,pipeline,windows=RELEASE_WINDOWS,tz=EASTERN,
+                 fast_interval=10.0,slow_interval=900.0,lead=datetime.timedelta(minutes=10),
+                 max_error_backoff=600.0,submit_workers=4,max_attempts=5):
+        """
+            gf - <GfcApi> - Client for polling and submitting
+
+            catalog - <QuestionCatalog> - Catalog to keep current
+
+            pipeline - <function> - Called with (ifps, catalog) for the active IFPs that
+                                    are new or have new clarifications (or whose
+                                    forecasts haven't all been submitted yet, once their
+                                    retry is due); returns the jobs to
+                                    submit, in any form submit_forecasts accepts
+                                    (nothing is submitted if it returns None)
+
+            windows - <list> - (weekday, start time, end time) release windows
+                Default: Wednesdays 12:30 - 14:00
+
+            tz - <tzinfo> - Time zone the windows are in
+                Default: America/New_York
+
+            fast_interval - <float> - Seconds between polls inside a window
+                Default: 10
+
+            slow_interval - <float> - Longest sleep between polls outside a window
+                Default: 900
+
+            lead - <timedelta> - How long before a window to start polling fast
+                Default: 10 minutes
+
+            max_error_backoff - <float> - Longest wait after failed polls, and before
+                                          retrying an IFP, which back off exponentially
+                                          from fast_interval
+                Default: 600
+
+            submit_workers - <integer> - Submissions in flight at once
+                Default: 4
+
+            max_attempts - <integer> - How many polls an IFP is handed to the pipeline
+                                       before it is given up on (None: never)
+                Default: 5
+        """
+        self.gf = gf
+        self.catalog = catalog
+        self.pipeline = pipeline
+        self.windows = windows
+        self.tz = tz
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.lead = lead
+        self.max_error_backoff = max_error_backoff
+        self.submit_workers = submit_workers
+        self.max_attempts = max_attempts
+        self._stop = threading.Event()
+        self._errors = 0
+        self._pending = {} # question_id -> (failed attempts so far, time.time() to retry at)
+
+    def stop(self):
+        """
+            Make run() return after the current poll (safe to call from another thread
+            or a signal handler).
+        """
+        self._stop.set()
+
+    def run(self,max_polls=None):
+        """
+            Poll until stop() is called (or max_polls polls have run).
+        """
+        polls = 0
+        while not self._stop.is_set():
+            self.poll()
+            polls += 1
+            if max_polls is not None and polls >= max_polls:
+                break
+            self._stop.wait(self.next_interval())
+
+    def poll(self):
+        """
+            Sync the catalog once and run the pipeline on any active IFP that is new or
+            clarified, plus those whose forecasts haven't all been submitted yet and are
+            due a retry.  A failed poll backs off the polling (see next_interval); a
+            failed pipeline or submission only backs off the IFPs involved.
+
+             Output:
+            The submit_forecasts report, or None if nothing was submitted
+        """
+        try:
+            changes = self.catalog.sync(self.gf)
+        except ValueError as err:
+            self._errors += 1
+            print("{}: question poll failed ({})".format(time.ctime(),err))
+            return None
+        self._errors = 0
+
+        for ifp in changes['new']:
+            print("{}: new IFP {}: {}".format(time.ctime(),ifp['id'],ifp['name']))
+        for ifp in changes['clarified']:
+            print("{}: IFP {} was clarified".format(time.ctime(),ifp['id']))
+        found = time.time()
+        for ifp in changes['new'] + changes['clarified']:
+            self._pending[ifp['id']] = (0,found) # a clarification gets a fresh set of attempts
+        # Closed (or vanished) IFPs are never forecast
+        self._pending = {q:due for q, due in self._pending.items()
+                         if q in self.catalog and question_status(self.catalog.get(q)) == 'active'}
+        ifps = [self.catalog.get(q) for q in sorted(self._pending) if self._pending[q][1] <= found]
+        if not ifps:
+            return None
+
+        try:
+            jobs = self.pipeline(ifps,self.catalog)
+            report = None
+            if jobs:
+                report = self.gf.submit_forecasts(jobs,questions=self.catalog.by_id,
+                                                  workers=self.submit_workers)
+        except Exception as err:
+            self._failed([ifp['id'] for ifp in ifps])
+            print("{}: forecasting IFPs {} failed ({!r})".format(
+                time.ctime(),', '.join(str(ifp['id']) for ifp in ifps),err))
+            return None
+
+        # An IFP is done once every job made for it went through (or none were made)
+        failed = set() if report is None else \
+            set(report.loc[report['status'] != 'submitted','question_id'].tolist())
+        for ifp in ifps:
+            if ifp['id'] not in failed:
+                del self._pending[ifp['id']]
+        self._failed(sorted(failed & set(self._pending)))
+        if report is None:
+            return None
+        submitted = int((report['status'] == 'submitted').sum())
+        print("{}: submitted {} of {} forecasts {:.1f}s after the IFPs were seen".format(
+            time.ctime(),submitted,len(report),time.time()-found))
+        return report
+
+    def pending(self):
+        """
+            Ids of the IFPs that will be handed to the pipeline again once their retry
+            is due.
+        """
+        return sorted(self._pending)
+
+    def _failed(self,question_ids):
+        """
+            Count a failed attempt against each IFP and schedule its retry, backing off
+            exponentially from fast_interval, or give up once it has used up max_attempts.
+        """
+        for question_id in question_ids:
+            attempts = self._pending[question_id][0] + 1
+            if self.max_attempts is not None and attempts >= self.max_attempts:
+                del self._pending[question_id]
+                print("{}: giving up on IFP {} after {} attempts".format(
+                    time.ctime(),question_id,self.max_attempts))
+                continue
+            wait = min(self.max_error_backoff,self.fast_interval * 2**attempts)
+            self._pending[question_id] = (attempts,time.time() + wait)
+
+    def in_window(self,now=None):
+        """
+            Whether 'now' (default: the current time) is within 'lead' of a release
+            window or inside one.
+        """
+        now = self._local(now)
+        for start, end in self._windows_around(now):
+            if start - self.lead <= now < end:
+                return True
+        return False
+
+    def next_interval(self,now=None):
+        """
+            Seconds to sleep before the next poll.
+        """
+        if self._errors:
+            return min(self.max_error_backoff,self.fast_interval * 2**self._errors)
+        now = self._local(now)
+        if self.in_window(now):
+            return self.fast_interval
+        wait = self.slow_interval
+        upcoming = [start - self.lead for start, _ in self._windows_around(now) if start - self.lead > now]
+        if upcoming:
+            wait = min(wait,(min(upcoming) - now).total_seconds())
+        if self._pending:
+            # Don't sleep past the next IFP retry
+            wait = min(wait,min(due for _, due in self._pending.values()) - now.timestamp())
+        return max(0.0,wait)
+
+    def _local(self,now):
+        if now is None:
+            return datetime.datetime.now(self.tz)
+        if now.tzinfo is None:
+            now = now.replace(tzinfo=datetime.timezone.utc)
+        return now.astimezone(self.tz)
+
+    def _windows_around(self,now):
+        """
+            The (start, end) datetimes of this week's and next week's windows.
+        """
+        monday = now.date() - datetime.timedelta(days=now.weekday())
+        out = []
+        for week in (0,7):
+            for weekday, start, end in self.windows:
+                day = monday + datetime.timedelta(days=week + weekday)
+                out.append((datetime.datetime.combine(day,start,tzinfo=self.tz),
+                            datetime.datetime.combine(day,end,tzinfo=self.tz)))
+        return out
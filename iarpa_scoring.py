@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Daily-averaged Brier scoring and backtests over resolved IFPs
+@author: tiffany
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import pandas
+
+from iarpa_index import ConsensusIndex, ForecastIndex, to_epoch_ns
+
+NS_PER_DAY = 86400 * 10**9
+CONSENSUS = 'consensus' # method name the crowd baseline is scored under
+
+def resolutions(questions):
+    """
+        Pull what scoring needs out of resolved IFPs (from get_questions(status='closed')).
+
+         Output:
+        A dictionary of question_id to a dictionary with
+            answer_ids - answer ids in the question's own order
+            outcome - 1.0 for the correct answer, 0.0 for the rest
+            start, end - first and last scored moments (int64 ns)
+            ordered - whether the answers are ordered bins
+        Questions without a known correct answer are skipped.
+    """
+    out = {}
+    for q in questions:
+        answers = q.get('answers') or []
+        outcome = numpy.array([1.0 if (a.get('correct?') or a.get('correct')) else 0.0 for a in answers])
+        if not len(outcome) or outcome.sum() != 1:
+            continue
+        start = q.get('starts_at') or q.get('published_at') or q.get('created_at')
+        end = q.get('resolved_at') or q.get('ends_at')
+        if not start or not end:
+            continue
+        out[q['id']] = {'answer_ids':numpy.array([a['id'] for a in answers],dtype=numpy.int64),
+                        'outcome':outcome,
+                        'start':to_epoch_ns(start),
+                        'end':to_epoch_ns(end),
+                        'ordered':'ordered' in str(q.get('type','')).lower()}
+    return out
+
+def brier(probs,outcome,ordered=False):
+    """
+        Multi-class Brier scores for many forecasts of one question.
+
+        probs - <array> - (..., n_answers) forecasts
+        outcome - <array> - (n_answers,) one-hot resolution
+        ordered - <boolean> - Score ordered bins as the mean of the binary Brier scores
+                              of every cumulative split (so near misses cost less)
+
+         Output:
+        An array of scores shaped like probs without its last axis (0 is perfect, 2
+        the worst possible unordered score)
+    """
+    if not ordered:
+        return ((probs - outcome)**2).sum(axis=-1)
+    cum_p = numpy.cumsum(probs,axis=-1)[...,:-1]
+    cum_o = numpy.cumsum(outcome)[:-1]
+    return (2*(cum_p - cum_o)**2).mean(axis=-1)
+
+def forecasts_to_flat(forecasts):
+    """
+        Turn a DataFrame of method forecasts (method, question_id, answer_id, value,
+        created_at) into the flattened prediction table ForecastIndex takes, with the
+        method standing in for the forecaster.
+    """
+    created = forecasts['created_at']
+    if not pandas.api.types.is_integer_dtype(created):
+        created = pandas.Series(to_epoch_ns(list(created)),index=forecasts.index)
+    set_ids, _ = pandas.factorize(pandas.MultiIndex.from_arrays(
+        [forecasts['method'],forecasts['question_id'],created]))
+    return pandas.DataFrame({'prediction_set_id':set_ids,
+                             'question_id':forecasts['question_id'].to_numpy(),
+                             'membership_guid':pandas.Categorical(forecasts['method'].astype(str)),
+                             'answer_id':forecasts['answer_id'].to_numpy(),
+                             'forecasted_probability':forecasts['value'].to_numpy(dtype=numpy.float64),
+                             'created_at':created.to_numpy(dtype=numpy.int64)})
+
+def daily_scores(resolved,forecasts=None,consensus=None):
+    """
+        Score every method on every resolved question on every day it was open.
+
+        Each day is scored on the forecast standing at the end of that day (the latest
+        one made at or before midnight UTC), so nothing from later in the day or after
+        it leaks in.  Days before a method's first forecast aren't scored.
+
+        resolved - <dictionary> - Output of resolutions()
+
+        forecasts - <DataFrame> or <ForecastIndex> - Method forecasts with columns
+                                                     method, question_id, answer_id,
+                                                     value and created_at
+            Default: None
+
+        consensus - <list>, <DataFrame> or <ConsensusIndex> - Consensus histories, scored
+                                                              as the 'consensus' method
+            Default: None
+
+         Output:
+        A DataFrame with columns method, question_id, day (int64 ns) and brier
+    """
+    if forecasts is not None and not isinstance(forecasts,ForecastIndex):
+        forecasts = ForecastIndex(forecasts_to_flat(forecasts))
+    if consensus is not None and not isinstance(consensus,ConsensusIndex):
+        consensus = ConsensusIndex(consensus)
+
+    frames = []
+    for question_id, r in resolved.items():
+        days, until = day_grid(r)
+        if not len(days):
+            continue
+
+        methods = []
+        grids = []
+        if forecasts is not None:
+            names, _, scores = daily_briers(forecasts,question_id,r)
+            if len(names):
+                methods.extend(names)
+                grids.append(scores)
+        if consensus is not None and question_id in consensus.question_ids():
+            probs = consensus.as_of_many(question_id,until)[:,None,:]
+            probs = _align(probs,numpy.array(consensus.answer_ids(question_id)),r['answer_ids'])
+            methods.append(CONSENSUS)
+            grids.append(brier(probs,r['outcome'],r['ordered']))
+        if not grids:
+            continue
+
+        scores = numpy.concatenate(grids,axis=1) # (days, methods)
+        scored = ~numpy.isnan(scores)
+        day_i, method_i = numpy.nonzero(scored)
+        frames.append(pandas.DataFrame({'method':numpy.asarray(methods,dtype=object)[method_i],
+                                        'question_id':question_id,
+                                        'day':days[day_i],
+                                        'brier':scores[scored]}))
+    if not frames:
+        return pandas.DataFrame(columns=['method','question_id','day','brier'])
+    return pandas.concat(frames,ignore_index=True)
+
+def day_grid(r):
+    """
+        The days a resolved question is scored on (one entry from resolutions()).
+
+         Output:
+        days - the midnight (int64 ns, UTC) ending each day the question was open
+        until - the moment each day is scored as of: its midnight, except the last
+                day, which stops at the resolution so later forecasts don't count
+    """
+    first_day = r['start'] - r['start'] % NS_PER_DAY
+    days = numpy.arange(first_day + NS_PER_DAY,r['end'] + NS_PER_DAY,NS_PER_DAY)
+    return days, numpy.minimum(days,r['end'])
+
+def daily_briers(forecasts,question_id,r):
+    """
+        Every forecaster's Brier score on each day of one resolved question.
+
+        forecasts - <ForecastIndex> - Keyed by forecaster (or method) and question
+
+        r - <dictionary> - The question's entry from resolutions()
+
+         Output:
+        names - forecasters (membership_guids) with a forecast on the question
+        days - see day_grid
+        scores - (len(days), len(names)) array, NaN before a forecaster's first forecast
+    """
+    days, until = day_grid(r)
+    names, answer_ids, probs = forecasts.as_of_many(question_id,until)
+    probs = _align(probs,answer_ids,r['answer_ids'])
+    return names, days, brier(probs,r['outcome'],r['ordered'])
+
+def _align(probs,answer_ids,question_answer_ids):
+    """
+        Reorder the last axis of probs into the question's answer order.  Answers a
+        forecast left out (e.g. the second answer of a binary question) share whatever
+        probability the given answers leave over.
+    """
+    out = numpy.full(probs.shape[:-1]+(len(question_answer_ids),),numpy.nan)
+    cols = pandas.Index(question_answer_ids).get_indexer(answer_ids)
+    known = cols >= 0
+    out[...,cols[known]] = probs[...,known]
+
+    given = ~numpy.isnan(out)
+    n_missing = (~given).sum(axis=-1,keepdims=True)
+    any_given = given.any(axis=-1,keepdims=True)
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        remainder = numpy.clip(1.0 - numpy.nansum(out,axis=-1,keepdims=True),0,1) / n_missing
+    return numpy.where(given | ~any_given,out,remainder)
+
+def summarize(scores):
+    """
+        Mean daily Brier per method and question, and each method's mean over questions.
+
+         Output:
+        (per_question, per_method) DataFrames
+    """
+    per_question = scores.groupby(['method','question_id'],as_index=False)['brier'].mean()
+    per_method = per_question.groupby('method')['brier'].agg(['mean','count']).sort_values('mean')
+    return per_question, per_method
+
+def score_parallel(resolved,forecasts=None,consensus=None,workers=None):
+    """
+        daily_scores spread over a process pool, one chunk of questions per worker.
+        forecasts and consensus are the DataFrames daily_scores accepts.
+    """
+    question_ids = list(resolved)
+    workers = workers or 1
+    chunks = [question_ids[i::workers] for i in range(workers)]
+    jobs = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        jobs.append(({q:resolved[q] for q in chunk},
+                     _subset(forecasts,chunk),
+                     _subset(consensus,chunk)))
+    if workers <= 1:
+        frames = [daily_scores(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(_daily_scores_job,jobs))
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return pandas.DataFrame(columns=['method','question_id','day','brier'])
+    return pandas.concat(frames,ignore_index=True)
+
+def grid_backtest(make_forecasts,grid,resolved,consensus=None,workers=None):
+    """
+        Score a forecasting method over a grid of parameter settings in a process pool.
+
+        make_forecasts - <function> - Module-level function taking a parameter dictionary
+                                      and returning a forecasts DataFrame (method,
+                                      question_id, answer_id, value, created_at)
+
+        grid - <dictionary> - Parameter name to list of values; every combination is run
+
+        resolved - <dictionary> - Output of resolutions()
+
+        consensus - <DataFrame> - Consensus histories to score as a baseline alongside
+            Default: None
+
+         Output:
+        A DataFrame with one row per parameter setting and method: the parameters, the
+        method, its mean daily Brier over questions and the number of questions scored
+    """
+    names = sorted(grid)
+    settings = [dict(zip(names,values)) for values in itertools.product(*(grid[n] for n in names))]
+    jobs = [(make_forecasts,params,resolved,consensus) for params in settings]
+    if workers is not None and workers <= 1:
+        results = [_grid_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_grid_job,jobs))
+    return pandas.concat(results,ignore_index=True)
+
+def _daily_scores_job(job):
+    return daily_scores(*job)
+
+def _grid_job(job):
+    make_forecasts, params, resolved, consensus = job
+    _, per_method = summarize(daily_scores(resolved,make_forecasts(params),consensus))
+    per_method = per_method.reset_index()
+    for name, value in params.items():
+        per_method[name] = [value]*len(per_method)
+    return per_method
+
+def _subset(records,question_ids):
+    if records is None:
+        return None
+    if not isinstance(records,pandas.DataFrame):
+        records = pandas.DataFrame.from_records(list(records))
+    return records[records['question_id'].isin(question_ids)]
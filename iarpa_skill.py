@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-forecaster track records and skill weights, updated incrementally from the
+prediction set stream and question resolutions
+@author: tiffany
+"""
+import warnings
+
+import numpy
+import pandas
+
+from iarpa_index import ForecastIndex, _as_ns
+from iarpa_scoring import daily_briers
+from iarpa_tables import flatten_prediction_sets
+
+class TrackRecord(object):
+    """
+        Every forecaster's forecast timeline per question (a ForecastIndex keyed by
+        membership_guid and question_id) and running accuracy statistics over the
+        resolved questions they forecast.
+
+        A forecaster's score on a question is their daily Brier score averaged over the
+        days they had a forecast standing (as in iarpa_scoring.daily_scores).  Their
+        relative score subtracts the mean of everyone's scores on that question, so
+        easy and hard questions count alike.  The running totals are plain arrays
+        indexed by forecaster, and each question's contribution is remembered, so:
+
+            update() with new prediction sets only rescores resolved questions that
+                     the batch touches (late-arriving forecasts)
+            resolve() only scores questions that are newly resolved (or whose outcome
+                      changed)
+
+        and weights() for any set of forecasters is one array lookup.
+
+            record = TrackRecord()
+            for batch in gf.iter_human_forecasts(batches=True):
+                record.update(batch)
+            record.resolve(resolutions(gf.get_questions(status='closed')))
+            engine.set_skill_weights(record.weights(active_since=cutoff))
+    """
+    def __init__(self,prediction_sets=None,prior_questions=5.0,strength=10.0):
+        """
+            prediction_sets - <list> or <DataFrame> - Prediction sets to start with
+
+            prior_questions - <float> - How many average questions a forecaster's record
+                                        is shrunk towards; newcomers get weights near 1
+                Default: 5
+
+            strength - <float> - How sharply weights fall with relative Brier score:
+                                 weight = exp(-strength * shrunk relative score)
+                Default: 10
+        """
+        self.prior_questions = prior_questions
+        self.strength = strength
+        self.forecasts = ForecastIndex()
+        self._resolved = {}     # question_id -> resolution it was scored with
+        self._scored = {}       # question_id -> (guid codes, brier, relative)
+        self._questions_of = {} # guid code -> set of question ids
+        self._count = numpy.zeros(0,dtype=numpy.int64)
+        self._sum = numpy.zeros(0)
+        self._sum_relative = numpy.zeros(0)
+        self._last_forecast = numpy.zeros(0,dtype=numpy.int64)
+        if prediction_sets is not None:
+            self.update(prediction_sets)
+
+    def update(self,prediction_sets):
+        """
+            Add prediction sets (API records, a page, or a flattened table).
+
+             Output:
+            The question ids in the batch
+        """
+        flat = prediction_sets
+        if not (isinstance(flat,pandas.DataFrame) and 'answer_id' in flat):
+            flat = flatten_prediction_sets(prediction_sets)
+        if flat.empty:
+            return []
+        self.forecasts.update(flat)
+        self._grow()
+
+        codes = self.forecasts.guids.get_indexer(flat['membership_guid'].astype(str))
+        numpy.maximum.at(self._last_forecast,codes,flat['created_at'].to_numpy(dtype=numpy.int64))
+        question_ids = flat['question_id'].to_numpy()
+        for code, question_id in set(zip(codes.tolist(),question_ids.tolist())):
+            self._questions_of.setdefault(code,set()).add(question_id)
+
+        touched = sorted(set(question_ids.tolist()))
+        for question_id in touched:
+            if question_id in self._resolved:
+                self._score(question_id,self._resolved[question_id])
+        return touched
+
+    def resolve(self,resolved):
+        """
+            Score newly resolved questions.
+
+            resolved - <dictionary> - Output of iarpa_scoring.resolutions; questions
+                                      already scored with the same outcome are skipped
+
+             Output:
+            Number of questions (re)scored
+        """
+        n = 0
+        for question_id, r in resolved.items():
+            old = self._resolved.get(question_id)
+            if old is not None and numpy.array_equal(old['outcome'],r['outcome']) \
+                    and numpy.array_equal(old['answer_ids'],r['answer_ids']) \
+                    and old['start'] == r['start'] and old['end'] == r['end']:
+                continue
+            self._resolved[question_id] = r
+            self._score(question_id,r)
+            n += 1
+        return n
+
+    def weights(self,guids=None,active_since=None):
+        """
+            Skill weights, 1.0 for a forecaster with no resolved record.
+
+            guids - <array-like> - membership_guids to look up
+                Default: None (every forecaster)
+
+            active_since - <datetime> or <int> - Only forecasters with a forecast at or
+                                                 after this time (only used when guids
+                                                 is None)
+                Default: None
+
+             Output:
+            For given guids, a numpy array in the same order; otherwise a Series
+            indexed by membership_guid (which AggregationEngine.set_skill_weights takes)
+        """
+        shrunk = self._sum_relative / (self._count + self.prior_questions)
+        w = numpy.exp(-self.strength * shrunk)
+        if guids is not None:
+            codes = self.forecasts.guids.get_indexer(pandas.Index(guids).astype(str))
+            return numpy.where(codes >= 0,w[codes],1.0)
+        keep = numpy.ones(len(w),dtype=bool)
+        if active_since is not None:
+            keep = self._last_forecast >= _as_ns([active_since])[0]
+        return pandas.Series(w[keep],index=self.forecasts.guids[keep],name='weight')
+
+    def stats(self):
+        """
+            The track record of every forecaster: a DataFrame indexed by
+            membership_guid with questions (resolved questions scored), mean_brier,
+            mean_relative (negative is better than the crowd), weight and
+            last_forecast (int64 ns).
+        """
+        with numpy.errstate(invalid='ignore',divide='ignore'):
+            mean = self._sum / self._count
+            relative = self._sum_relative / self._count
+        return pandas.DataFrame({'questions':self._count,
+                                 'mean_brier':mean,
+                                 'mean_relative':relative,
+                                 'weight':self.weights(self.forecasts.guids),
+                                 'last_forecast':self._last_forecast},
+                                index=pandas.Index(self.forecasts.guids,name='membership_guid'))
+
+    def timeline(self,guid):
+        """
+            One forecaster's forecasts across every question, in (question, time)
+            order: question_id, prediction_set_id, created_at, answer_id and
+            forecasted_probability.
+        """
+        code = self.forecasts.guids.get_indexer([guid])[0]
+        frames = []
+        for question_id in sorted(self._questions_of.get(code,())):
+            df = self.forecasts.history(question_id,guid)
+            df = df.melt(id_vars=['prediction_set_id','created_at'],var_name='answer_id',
+                         value_name='forecasted_probability').dropna(subset=['forecasted_probability'])
+            df.insert(0,'question_id',question_id)
+            frames.append(df.sort_values(['created_at','answer_id'],kind='stable'))
+        if not frames:
+            return pandas.DataFrame(columns=['question_id','prediction_set_id','created_at',
+                                             'answer_id','forecasted_probability'])
+        return pandas.concat(frames,ignore_index=True)
+
+    def _score(self,question_id,r):
+        """
+            (Re)compute every forecaster's score on one resolved question and swap it
+            into the running totals.
+        """
+        old = self._scored.pop(question_id,None)
+        if old is not None:
+            codes, scores, relative = old
+            numpy.subtract.at(self._count,codes,1)
+            numpy.subtract.at(self._sum,codes,scores)
+            numpy.subtract.at(self._sum_relative,codes,relative)
+
+        guids, days, daily = daily_briers(self.forecasts,question_id,r)
+        if not len(days) or not len(guids):
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning) # forecasters with no scored days
+            scores = numpy.nanmean(daily,axis=0)
+        scored = ~numpy.isnan(scores)
+        if not scored.any():
+            return
+        codes = self.forecasts.guids.get_indexer(guids[scored])
+        scores = scores[scored]
+        relative = scores - scores.mean()
+
+        numpy.add.at(self._count,codes,1)
+        numpy.add.at(self._sum,codes,scores)
+        numpy.add.at(self._sum_relative,codes,relative)
+        self._scored[question_id] = (codes,scores,relative)
+
+    def _grow(self):
+        n = len(self.forecasts.guids) - len(self._count)
+        if n > 0:
+            self._count = numpy.concatenate([self._count,numpy.zeros(n,dtype=numpy.int64)])
+            self._sum = numpy.concatenate([self._sum,numpy.zeros(n)])
+            self._sum_relative = numpy.concatenate([self._sum_relative,numpy.zeros(n)])
+            self._last_forecast = numpy.concatenate([self._last_forecast,
+                                                     numpy.full(n,numpy.iinfo(numpy.int64).min)])
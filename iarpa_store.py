@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk store for prediction sets and consensus histories
+@author: tiffany
+"""
+import os
+
+import pandas
+
+# Column used to place each record in a date partition.  Neither created_at nor
+# question_id changes when a record is updated, so a record id always lands in
+# the same partition and upserts only ever have to rewrite that one file.
+PARTITION_COLUMNS = {'prediction_sets':'created_at',
+                     'consensus_histories':'created_at',
+                     'questions':'created_at'}
+
+# Questions are their own question_id
+QUESTION_ID_COLUMNS = {'questions':'id'}
+
+TIMESTAMP_COLUMNS = ('created_at','updated_at','consensus_at','published_at',
+                     'starts_at','ends_at','resolved_at')
+
+class LocalStore(object):
+    """
+        Keeps API datasets as parquet files partitioned by question_id and by month of
+        creation:
+
+            <root>/<dataset>/question_id=<id>/month=<YYYY-MM>/data.parquet
+
+        New batches are upserted by record id (the latest updated_at wins), and loads
+        read only the partitions and columns that are asked for.  Requires pyarrow
+        (or fastparquet) for pandas' parquet support.
+    """
+    def __init__(self,root):
+        """
+            root - <string> - Directory the store lives in.  Created if it doesn't exist.
+        """
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def upsert(self,dataset,records,id_column='id'):
+        """
+            Insert or replace records in a dataset.
+
+            dataset - <string> - e.g. 'prediction_sets' or 'consensus_histories'
+
+            records - <list> or <DataFrame> - Records as returned by the API (a list of
+                                              dictionaries, e.g. one page from iter_pages)
+                                              or an equivalent DataFrame
+
+            id_column - <string> - Column that identifies a record
+                Default: 'id'
+
+             Output:
+            Number of records written
+        """
+        df = self._to_frame(records)
+        if df.empty:
+            return 0
+
+        part_col = PARTITION_COLUMNS.get(dataset,'created_at')
+        question_col = QUESTION_ID_COLUMNS.get(dataset,'question_id')
+        months = df[part_col].dt.strftime('%Y-%m')
+        for (question_id, month), chunk in df.groupby([df[question_col],months],sort=False):
+            path = self._partition_path(dataset,question_id,month)
+            if os.path.isfile(path):
+                chunk = pandas.concat([pandas.read_parquet(path),chunk],ignore_index=True)
+            if 'updated_at' in chunk:
+                chunk = chunk.sort_values('updated_at',kind='stable')
+            chunk = chunk.drop_duplicates(subset=id_column,keep='last')
+            chunk = chunk.sort_values(id_column).reset_index(drop=True)
+            self._write(path,chunk)
+
+        return len(df)
+
+    def load(self,dataset,columns=None,question_ids=None,start=None,end=None):
+        """
+            Read a dataset back as a DataFrame.
+
+            columns - <list> - Only read these columns
+                Default: None (all columns)
+
+            question_ids - <list> - Only read these questions' partitions
+                Default: None (all questions)
+
+            start, end - <datetime> - Only return records whose partition column
+                                      (created_at) falls in [start, end).  Partitions
+                                      outside the range are never opened.
+                Default: None (no limit)
+        """
+        part_col = PARTITION_COLUMNS.get(dataset,'created_at')
+        start = _utc(start)
+        end = _utc(end)
+
+        read_columns = columns
+        if columns is not None and (start is not None or end is not None) and part_col not in columns:
+            read_columns = list(columns) + [part_col]
+
+        frames = []
+        for path in self._partitions(dataset,question_ids,start,end):
+            frames.append(pandas.read_parquet(path,columns=read_columns))
+        if not frames:
+            return pandas.DataFrame(columns=columns)
+        df = pandas.concat(frames,ignore_index=True)
+
+        if start is not None:
+            df = df[df[part_col] >= start]
+        if end is not None:
+            df = df[df[part_col] < end]
+        if columns is not None:
+            df = df[list(columns)]
+        return df.reset_index(drop=True)
+
+    def max_timestamp(self,dataset,columns=('created_at','updated_at')):
+        """
+            The latest value of any of 'columns' in a dataset, reading only those columns.
+            Returns None for an empty dataset.
+        """
+        latest = None
+        for path in self._partitions(dataset):
+            df = pandas.read_parquet(path,columns=list(columns))
+            for col in columns:
+                value = df[col].max()
+                if not pandas.isnull(value) and (latest is None or value > latest):
+                    latest = value
+        return latest
+
+    def is_empty(self,dataset):
+        for path in self._partitions(dataset):
+            return False
+        return True
+
+    def question_ids(self,dataset):
+        """
+            The question ids that have at least one partition in a dataset.
+        """
+        base = os.path.join(self.root,dataset)
+        if not os.path.isdir(base):
+            return []
+        return sorted(int(d.split('=',1)[1]) for d in os.listdir(base) if d.startswith('question_id='))
+
+    def _partitions(self,dataset,question_ids=None,start=None,end=None):
+        base = os.path.join(self.root,dataset)
+        if question_ids is None:
+            question_ids = self.question_ids(dataset)
+        first = start.strftime('%Y-%m') if start is not None else None
+        last = end.strftime('%Y-%m') if end is not None else None
+
+        for question_id in question_ids:
+            qdir = os.path.join(base,'question_id={}'.format(question_id))
+            if not os.path.isdir(qdir):
+                continue
+            for mdir in sorted(os.listdir(qdir)):
+                month = mdir.split('=',1)[1]
+                if (first is not None and month < first) or (last is not None and month > last):
+                    continue
+                path = os.path.join(qdir,mdir,'data.parquet')
+                if os.path.isfile(path):
+                    yield path
+
+    def _partition_path(self,dataset,question_id,month):
+        return os.path.join(self.root,dataset,'question_id={}'.format(question_id),
+                            'month={}'.format(month),'data.parquet')
+
+    def _write(self,path,df):
+        """
+            Write a partition via a temporary file so a crash never leaves half a file.
+        """
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + '.tmp'
+        df.to_parquet(tmp,index=False)
+        os.replace(tmp,path)
+
+    def _to_frame(self,records):
+        if isinstance(records,pandas.DataFrame):
+            df = records.copy()
+        elif isinstance(records,dict):
+            # get_* methods hand back the API's error json instead of a list
+            raise ValueError("Expected a list of records, got {}".format(records))
+        else:
+            df = pandas.DataFrame.from_records(list(records))
+        for col in TIMESTAMP_COLUMNS:
+            if col in df:
+                df[col] = pandas.to_datetime(df[col],utc=True,format='ISO8601')
+        return df
+
+def _utc(value):
+    if value is None:
+        return None
+    value = pandas.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize('UTC')
+    return value
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk, validated forecast submission
+@author: tiffany
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas
+import requests
+
+MAX_METHOD_NAME = 50
+DECIMALS = 6 # submitted values are rounded to this many places
+
+def validate_forecasts(jobs,questions=None,decimals=DECIMALS):
+    """
+        Check and normalize many forecasts at once, before anything is sent.
+
+        jobs - <list> - (question_id, method_name, predictions) tuples or dictionaries
+                        with those keys, where predictions is a list of
+                        {'answer_id': <Integer>, 'value': <Decimal>}
+
+        questions - <list> or <dictionary> - IFPs from get_questions (or a dictionary of
+                                             question_id to IFP).  When given, answer ids
+                                             are checked against each question and binary
+                                             questions are cut down to the single
+                                             prediction the API expects (see
+                                             GfcApi._forecast_template).
+            Default: None
+
+         Output:
+        A list with one (predictions, error) pair per job.  'predictions' is the
+        normalized list to submit, rounded so the values sum to exactly 1.0; 'error'
+        is None or a message saying why the job can't be submitted (e.g. an answer id
+        given twice, or, for a known question, ids that aren't exactly its answers).
+    """
+    jobs = [_job_tuple(j) for j in jobs]
+    if isinstance(questions,list):
+        questions = {q['id']:q for q in questions}
+
+    # Lay every prediction of every job out in flat arrays
+    counts = numpy.array([len(p) for _, _, p in jobs],dtype=numpy.int64)
+    job_of = numpy.repeat(numpy.arange(len(jobs)),counts)
+    answer_ids = numpy.array([p['answer_id'] for _, _, preds in jobs for p in preds],dtype=numpy.int64)
+    values = numpy.array([p['value'] for _, _, preds in jobs for p in preds],dtype=numpy.float64)
+
+    errors = [None]*len(jobs)
+    bad_value = ~numpy.isfinite(values) | (values < 0) | (values > 1)
+    for j in numpy.unique(job_of[bad_value]):
+        errors[j] = 'values must be between 0 and 1'
+
+    # Each answer may appear once per forecast
+    if len(answer_ids):
+        _, first = numpy.unique(numpy.stack([job_of,answer_ids],axis=1),axis=0,return_index=True)
+        repeated = numpy.ones(len(answer_ids),dtype=bool)
+        repeated[first] = False
+        for j in numpy.unique(job_of[repeated]):
+            errors[j] = errors[j] or 'answer ids must not repeat'
+
+    # Binary questions only take the first answer's probability.  A pair is
+    # normalized first; a lone value for the second answer becomes its complement.
+    keep = numpy.ones(len(values),dtype=bool)
+    if questions is not None:
+        for j, (question_id, _, _) in enumerate(jobs):
+            ifp = questions.get(question_id)
+            if ifp is None:
+                errors[j] = errors[j] or 'unknown question {}'.format(question_id)
+                continue
+            ids = [a['id'] for a in ifp['answers']]
+            mine = job_of == j
+            given = numpy.flatnonzero(mine)
+            if not numpy.isin(answer_ids[mine],ids).all():
+                errors[j] = errors[j] or 'answer ids do not belong to question {}'.format(question_id)
+            elif len(ids) == 2:
+                if len(given) == 1 and answer_ids[given[0]] == ids[1]:
+                    values[given[0]] = 1.0 - values[given[0]]
+                    answer_ids[given[0]] = ids[0]
+                keep[mine] = answer_ids[mine] == ids[0]
+            elif len(numpy.unique(answer_ids[mine])) != len(ids):
+                errors[j] = errors[j] or 'forecast must cover all {} answers'.format(len(ids))
+
+    # A single value is a binary forecast and is sent as is; everything else is
+    # normalized to sum to one
+    single = counts == 1
+    sums = numpy.bincount(job_of,weights=numpy.where(bad_value,0,values),minlength=len(jobs))
+    for j in numpy.flatnonzero((sums <= 0) & (counts > 1)):
+        errors[j] = errors[j] or 'values sum to zero'
+    for j in numpy.flatnonzero(counts == 0):
+        errors[j] = 'no predictions'
+    scale = numpy.where(single | (sums <= 0),1.0,1.0/numpy.where(sums > 0,sums,1.0))
+    values = numpy.round(values*scale[job_of],decimals)
+
+    output = []
+    for j, (question_id, method_name, _) in enumerate(jobs):
+        if not isinstance(method_name,str) or not 0 < len(method_name) <= MAX_METHOD_NAME:
+            errors[j] = errors[j] or 'method_name must be 1-{} characters'.format(MAX_METHOD_NAME)
+        if errors[j] is not None:
+            output.append((None,errors[j]))
+            continue
+        mine = numpy.flatnonzero((job_of == j) & keep)
+        vals = values[mine]
+        if len(vals) > 1:
+            # Put the rounding residue on the largest value so the sum is exact
+            vals[numpy.argmax(vals)] += round(1.0 - vals.sum(),decimals)
+            vals = numpy.round(vals,decimals)
+        output.append(([{'answer_id':int(a),'value':float(v)} for a, v in zip(answer_ids[mine],vals)],
+                       None))
+    return output
+
+def submit_forecasts(gf,jobs,questions=None,workers=4,retries=2):
+    """
+        Validate and submit many forecasts through a pool of workers sharing gf's rate
+        limiter.
+
+        gf - <GfcApi> - Client to submit with
+
+        jobs - <list> - See validate_forecasts
+
+        questions - <list> or <dictionary> - See validate_forecasts
+            Default: None
+
+        workers - <integer> - Number of submissions in flight at once
+            Default: 4
+
+        retries - <integer> - Times a submission is retried after a connection error or a
+                              response that isn't json
+            Default: 2
+
+         Output:
+        A DataFrame with one row per job: question_id, method_name, status ('submitted',
+        'rejected' if the API returned errors, 'invalid' if it failed validation, or
+        'failed'), attempts, error and the API's response.
+    """
+    jobs = [_job_tuple(j) for j in jobs]
+    checked = validate_forecasts(jobs,questions)
+
+    def submit(job,predictions):
+        question_id, method_name, _ = job
+        attempts = 0
+        while True:
+            attempts+=1
+            try:
+                resp = gf.submit_forecast(question_id,method_name,predictions)
+            except (requests.exceptions.RequestException,ValueError) as err:
+                if attempts > retries:
+                    return 'failed', attempts, str(err), None
+                time.sleep(min(2**attempts,30))
+                continue
+            if isinstance(resp,dict) and 'errors' in resp:
+                return 'rejected', attempts, str(resp['errors']), resp
+            return 'submitted', attempts, None, resp
+
+    results = [None]*len(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i, (job, (predictions, error)) in enumerate(zip(jobs,checked)):
+            if error is not None:
+                results[i] = ('invalid',0,error,None)
+            else:
+                futures[i] = pool.submit(submit,job,predictions)
+        for i, future in futures.items():
+            results[i] = future.result()
+
+    return _report(jobs,results)
+
+def _report(jobs,results):
+    """
+        The submission report: one (status, attempts, error, response) result per job.
+    """
+    report = pandas.DataFrame(results,columns=['status','attempts','error','response'])
+    report.insert(0,'question_id',[j[0] for j in jobs])
+    report.insert(1,'method_name',[j[1] for j in jobs])
+    return report
+
+def _job_tuple(job):
+    if isinstance(job,dict):
+        return job['question_id'], job['method_name'], job['predictions']
+    return tuple(job)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpointed, resumable incremental sync of the GF Challenge API into a LocalStore
+@author: tiffany
+"""
+import datetime
+import json
+import os
+
+import pandas
+
+# endpoint name -> (GfcApi url attribute, json section, fixed query params)
+ENDPOINTS = {'questions':('questions_url','questions',{'status':'all'}),
+             'prediction_sets':('prediction_sets_url','prediction_sets',{}),
+             'consensus_histories':('consensus_histories_url','consensus_histories',{})}
+
+class SyncEngine(object):
+    """
+        Pulls only what has changed since the last sync for each endpoint and upserts it
+        into a LocalStore.
+
+        A record that was created after the watermark was also updated after it, so a
+        single updated_after query covers both new and changed records - there is no
+        separate created_after pass to reconcile, and the store's id upsert absorbs
+        whatever overlap remains.
+
+        Each run freezes its window (updated_after the watermark, updated_before the
+        time the run started) and checkpoints the last page written to the store.  If
+        the run dies, the next call to sync() re-issues the same window starting from
+        the page after the checkpoint.  The watermark only moves once every page of the
+        window is in the store.
+
+        Pages are buffered and upserted 'flush_records' at a time: a page touches
+        dozens of partitions and upsert rewrites each one it touches, so writing page
+        by page rewrites the same partitions over and over.  The checkpoint moves once
+        per flush; a crash re-pulls at most the pages still in the buffer.
+    """
+    def __init__(self,gf,store,state_path=None,overlap=datetime.timedelta(seconds=60),
+                 flush_records=20000):
+        """
+            gf - <GfcApi> - Client used for the pulls
+
+            store - <LocalStore> - Where records are upserted
+
+            state_path - <string> - JSON file holding watermarks and checkpoints
+                Default: sync_state.json in the store's root
+
+            overlap - <timedelta> - How far before the watermark each window starts, to
+                                    cover clock skew between us and the server
+                Default: 60 seconds
+
+            flush_records - <integer> - How many records to buffer before upserting them
+                                        and moving the checkpoint
+                Default: 20000
+        """
+        self.gf = gf
+        self.store = store
+        self.state_path = state_path or os.path.join(store.root,'sync_state.json')
+        self.overlap = overlap
+        self.flush_records = flush_records
+        self.state = self._load_state()
+
+    def sync_all(self):
+        """
+            Sync every endpoint.  Returns a dictionary of records written per endpoint.
+        """
+        return {endpoint:self.sync(endpoint) for endpoint in ENDPOINTS}
+
+    def sync(self,endpoint):
+        """
+            Bring one endpoint ('questions', 'prediction_sets' or 'consensus_histories')
+            up to date, resuming an interrupted run if there is one.
+
+             Output:
+            Number of records written to the store
+        """
+        url_attr, section, fixed_params = ENDPOINTS[endpoint]
+        state = self.state.setdefault(endpoint,{'watermark':None})
+
+        if state.get('window') is None:
+            # Fresh run: freeze the window and start at page 1
+            window = {'updated_before':_now().isoformat(),'last_page':0,'max_seen':None}
+            if state['watermark'] is not None:
+                start = pandas.Timestamp(state['watermark']) - self.overlap
+                window['updated_after'] = start.isoformat()
+            state['window'] = window
+            self._save_state()
+        else:
+            window = state['window']
+            if self.gf.verbose:
+                print("Resuming {} sync after page {}".format(endpoint,window['last_page']))
+
+        params = dict(fixed_params)
+        params['updated_before'] = window['updated_before']
+        if window.get('updated_after'):
+            params['updated_after'] = window['updated_after']
+
+        written = 0
+        page = window['last_page']+1
+        buffered = []
+        for batch in self.gf.iter_pages(url=getattr(self.gf,url_attr),params=params,
+                                        section=section,start_page=page):
+            buffered.extend(batch)
+            if len(buffered) >= self.flush_records:
+                written += self._flush(endpoint,window,buffered,page)
+                buffered = []
+            page+=1
+        if buffered:
+            written += self._flush(endpoint,window,buffered,page-1)
+
+        # The whole window is in the store; move the watermark and clear the checkpoint
+        if window['max_seen'] is not None:
+            state['watermark'] = window['max_seen']
+        state['window'] = None
+        self._save_state()
+        return written
+
+    def _flush(self,endpoint,window,records,last_page):
+        """
+            Upsert buffered records and checkpoint the last page they came from.
+        """
+        written = self.store.upsert(endpoint,records)
+        window['max_seen'] = _latest(window['max_seen'],records)
+        window['last_page'] = last_page
+        self._save_state()
+        return written
+
+    def watermark(self,endpoint):
+        """
+            The latest updated_at synced for an endpoint, or None before the first sync.
+        """
+        return self.state.get(endpoint,{}).get('watermark')
+
+    def reset(self,endpoint):
+        """
+            Forget an endpoint's watermark and checkpoint so the next sync is a full pull.
+        """
+        self.state.pop(endpoint,None)
+        self._save_state()
+
+    def _load_state(self):
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as infile:
+                return json.load(infile)
+        return {}
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp,'w') as outfile:
+            json.dump(self.state,outfile,indent=2)
+        os.replace(tmp,self.state_path)
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _latest(current,batch):
+    """
+        Fold a page's updated_at (or created_at) values into the running maximum,
+        returning an ISO string.
+    """
+    stamps = [r.get('updated_at') or r.get('created_at') for r in batch]
+    stamps = [t for t in stamps if t]
+    if current is not None:
+        stamps.append(current)
+    if not stamps:
+        return current
+    return pandas.to_datetime(stamps,utc=True,format='ISO8601').max().isoformat()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Flattening of API records into compact long-format tables
+@author: tiffany
+"""
+import numpy
+import pandas
+from pandas.api.types import union_categoricals
+
+FLAT_PREDICTION_COLUMNS = ['prediction_set_id','question_id','membership_guid','answer_id',
+                           'forecasted_probability','created_at']
+
+def flatten_prediction_sets(prediction_sets):
+    """
+        Turn prediction sets (from get_human_forecasts, one page from
+        iter_human_forecasts(batches=True), or a LocalStore DataFrame) into one row per
+        predicted answer:
+
+            prediction_set_id - int64
+            question_id - int32
+            membership_guid - category
+            answer_id - int32
+            forecasted_probability - float64
+            created_at - int64 nanoseconds since the epoch (UTC)
+
+        Only the nested predictions are walked per answer; everything that belongs to
+        the prediction set is decoded once per set and repeated with numpy.
+    """
+    if isinstance(prediction_sets,pandas.DataFrame):
+        rows = zip(prediction_sets['id'],prediction_sets['question_id'],
+                   prediction_sets['membership_guid'],prediction_sets['created_at'],
+                   prediction_sets['predictions'])
+    else:
+        rows = ((ps['id'],ps['question_id'],ps['membership_guid'],ps['created_at'],
+                 ps['predictions']) for ps in prediction_sets)
+
+    set_ids = []
+    question_ids = []
+    guids = []
+    created = []
+    counts = []
+    answer_ids = []
+    probabilities = []
+    for set_id, question_id, guid, created_at, predictions in rows:
+        set_ids.append(set_id)
+        question_ids.append(question_id)
+        guids.append(guid)
+        created.append(created_at)
+        counts.append(len(predictions))
+        for p in predictions:
+            answer_ids.append(p['answer_id'])
+            probabilities.append(p['forecasted_probability'])
+
+    counts = numpy.asarray(counts,dtype=numpy.int64)
+    guid_cat = pandas.Categorical(guids)
+    created_ns = _to_epoch_ns(created)
+
+    return pandas.DataFrame({
+        'prediction_set_id':numpy.repeat(numpy.asarray(set_ids,dtype=numpy.int64),counts),
+        'question_id':numpy.repeat(numpy.asarray(question_ids,dtype=numpy.int32),counts),
+        'membership_guid':pandas.Categorical.from_codes(numpy.repeat(guid_cat.codes,counts),
+                                                        guid_cat.categories),
+        'answer_id':numpy.asarray(answer_ids,dtype=numpy.int32),
+        'forecasted_probability':numpy.asarray(probabilities,dtype=numpy.float64),
+        'created_at':numpy.repeat(created_ns,counts)},
+        columns=FLAT_PREDICTION_COLUMNS)
+
+def iter_flat_prediction_sets(batches):
+    """
+        Flatten a stream of prediction set pages (e.g. iter_human_forecasts(batches=True))
+        one page at a time.
+    """
+    for batch in batches:
+        yield flatten_prediction_sets(batch)
+
+def concat_flat(frames):
+    """
+        Concatenate flattened frames, merging the membership_guid categories instead of
+        falling back to an object column.
+    """
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return flatten_prediction_sets([])
+    guids = union_categoricals([f['membership_guid'] for f in frames])
+    df = pandas.concat([f.drop(columns='membership_guid') for f in frames],ignore_index=True)
+    df.insert(FLAT_PREDICTION_COLUMNS.index('membership_guid'),'membership_guid',guids)
+    return df
+
+def _to_epoch_ns(values):
+    if not len(values):
+        return numpy.zeros(0,dtype=numpy.int64)
+    stamps = pandas.to_datetime(pandas.Series(values),utc=True,format='ISO8601')
+    return stamps.astype('datetime64[ns, UTC]').to_numpy(dtype='datetime64[ns]').view(numpy.int64)